@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Reproducible throughput benchmarks for the layout and render pipeline
+Runs every workload on seeded corpora of 1, 10, 100 and 1000 pages and compares against a stored baseline
+
+Timings only compare on the machine that produced them, so no baseline is checked in. Record one with
+    python benchmark.py --font /path/to/font.ttf --save-baseline
+before a change, then run the same command without --save-baseline to list workloads that got slower.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+SIZES = (1, 10, 100, 1000)
+WORDS_PER_PAGE = 450
+SEED = 1234
+TOLERANCE = 0.10
+WORKDIR = None
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore "
+    "magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo "
+    "consequat duis aute irure in reprehenderit voluptate velit esse cillum eu fugiat nulla pariatur excepteur "
+    "sint occaecat cupidatat non proident sunt culpa qui officia deserunt mollit anim id est laborum"
+).split()
+
+
+def corpus(pages: int, seed: int = SEED) -> list[str]:
+    """Paragraphs of 40-120 words totalling `pages` * WORDS_PER_PAGE words, identical on every run."""
+    rng = random.Random(f"{seed}:{pages}")
+    paragraphs = []
+    remaining = pages * WORDS_PER_PAGE
+    while remaining > 0:
+        count = min(remaining, rng.randint(40, 120))
+        words = [rng.choice(WORDS) for _ in range(count)]
+        words[0] = words[0].capitalize()
+        paragraphs.append(" ".join(words) + ".")
+        remaining -= count
+    return paragraphs
+
+
+class Sink:
+    """Accepts any command, so parser.interpret only measures parsing and dispatch."""
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def reset_caches():
+    """Start a workload from empty in-process and on-disk caches."""
+    os.chdir(tempfile.mkdtemp(dir=WORKDIR))
+    if "linebreak" in sys.modules:
+        from linebreak import BreakCache
+        BreakCache._db = None
+        BreakCache.pending = {}
+        BreakCache.used = set()
+        BreakCache.hits = BreakCache.misses = 0
+    if "text_metrics" in sys.modules:
+        from text_metrics.cache_manager import WordCacheManager
+        from text_metrics.metrics import LINE_HEIGHTS
+        WordCacheManager._shards = {}
+        WordCacheManager._metrics = None
+        WordCacheManager._new_metrics = {}
+        WordCacheManager.hits = WordCacheManager.misses = 0
+        LINE_HEIGHTS.clear()
+    if "layout" in sys.modules:
+        from layout import GlyphTable
+        GlyphTable._tables.clear()
+
+
+def cache_stats():
+    """Cache counters so far in this process; timed() reports how much one run added to them."""
+    stats = {}
+    if "linebreak" in sys.modules:
+        from linebreak import BreakCache
+        stats["break_cache"] = {"hits": BreakCache.hits, "misses": BreakCache.misses}
+    if "text_metrics" in sys.modules:
+        from text_metrics.cache_manager import WordCacheManager
+        stats["word_cache"] = {"hits": WordCacheManager.hits, "misses": WordCacheManager.misses}
+    return stats
+
+
+# --- Workloads: each takes the corpus and returns a callable that does the measured work ---
+
+def bench_interpret(paragraphs, font):
+    from parser import interpret
+    code = ";document()\n" + "\n".join(f";paragraph(): {p}" for p in paragraphs)
+    return lambda: interpret(Sink(), code)
+
+def bench_parse(paragraphs, font):
+    import bookmark
+
+    class ParseOnly(bookmark.Document):
+        def __init__(self):
+            self.parser = bookmark.Parser(self)
+
+        def document(self, *args, **kwargs):
+            pass
+
+        def paragraph(self, text=None, *args, **kwargs):
+            if not isinstance(text, str):
+                for _ in text:
+                    pass
+
+    Path("corpus.bkm").write_text(";document()\n" + "\n".join(f";paragraph():\n{p}\n" for p in paragraphs))
+    def run():
+        parser = ParseOnly().parser
+        with open("corpus.bkm") as f:
+            for block in parser.parse(f):
+                parser.dispatch(block)
+    return run
+
+def bench_justifytext(paragraphs, font):
+    import bookmark
+    doc = bookmark.Document.__new__(bookmark.Document)
+    doc.document()
+    doc.setmargin(all=50)
+    text = "\n".join(paragraphs)
+    def run():
+        doc.cursor_y = doc.pagesize[1] - doc.margin[0]
+        return len(doc.justifytext(text))
+    return run
+
+def bench_textlayout(paragraphs, font):
+    from layout import TextLayout
+    return lambda: sum(TextLayout(p, font, 12).lines(450) for p in paragraphs)
+
+def bench_bkm_paragraph(paragraphs, font):
+    import bkm
+    def run():
+        doc = bkm.BKM()
+        doc.document(measurer="freetype")
+        doc.page()
+        for p in paragraphs:
+            doc.paragraph(p, font=(font, 12))
+        return doc
+    return run
+
+def bench_bkm_write(paragraphs, font):
+    # write() only reads the pages it serializes, so every run writes the same document again.
+    doc = bench_bkm_paragraph(paragraphs, font)()
+    def run():
+        # write() prints a progress line, which would land in the JSON report when that goes to stdout.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            doc.write()
+    return run
+
+# Workloads that measure with FreeType and need a font file
+FONT_WORKLOADS = {"TextLayout.lines", "BKM.paragraph", "BKM.write"}
+
+WORKLOADS = {
+    "parser.interpret": bench_interpret,
+    "bookmark.Parser.parse": bench_parse,
+    "Document.justifytext": bench_justifytext,
+    "TextLayout.lines": bench_textlayout,
+    "BKM.paragraph": bench_bkm_paragraph,
+    "BKM.write": bench_bkm_write,
+}
+
+
+def timed(run, words, pages):
+    before = cache_stats()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    stats = {cache: {name: value - before.get(cache, {}).get(name, 0) for name, value in counters.items()}
+             for cache, counters in cache_stats().items()}
+    return {"seconds": seconds, "words_per_sec": words / seconds, "pages_per_sec": pages / seconds, **stats}
+
+def measure(name, paragraphs, pages, font, memory=True):
+    words = sum(len(p.split()) for p in paragraphs)
+    try:
+        reset_caches()
+        run = WORKLOADS[name](paragraphs, font)
+        result = {"cold": timed(run, words, pages)}
+        result["warm"] = timed(run, words, pages)
+        if memory:
+            tracemalloc.start()
+            run()
+            result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return result
+    except Exception as e:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return {"error": f"{type(e).__name__}: {e}"}
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Workloads whose warm or cold words/sec dropped more than `tolerance` below the baseline."""
+    regressions = []
+    for size, workloads in results.items():
+        for name, result in workloads.items():
+            base = baseline.get("results", {}).get(size, {}).get(name, {})
+            for run in ("cold", "warm"):
+                if run not in result or run not in base:
+                    continue
+                ratio = result[run]["words_per_sec"] / base[run]["words_per_sec"]
+                if ratio < 1 - tolerance:
+                    regressions.append({"pages": size, "workload": name, "run": run, "ratio": round(ratio, 3)})
+    return regressions
+
+
+def print_table(results, regressions):
+    slow = {(r["pages"], r["workload"], r["run"]) for r in regressions}
+    print(f"{'pages':>6}  {'workload':<24} {'cold words/s':>14} {'warm words/s':>14} {'peak MiB':>9}", file=sys.stderr)
+    for size, workloads in results.items():
+        for name, result in workloads.items():
+            if "error" in result:
+                print(f"{size:>6}  {name:<24} {result['error']}", file=sys.stderr)
+                continue
+            cells = []
+            for run in ("cold", "warm"):
+                mark = "!" if (size, name, run) in slow else " "
+                cells.append(f"{result[run]['words_per_sec']:>13,.0f}{mark}")
+            peak = result.get("peak_memory")
+            print(f"{size:>6}  {name:<24} {cells[0]} {cells[1]} {peak / 2**20 if peak else 0:>9.1f}", file=sys.stderr)
+
+
+def main():
+    global WORKDIR
+    parser = argparse.ArgumentParser(description="Benchmark the layout and render pipeline on seeded corpora")
+    parser.add_argument("--font", help="TTF/OTF file for the FreeType-based workloads (default: resolve Helvetica/Arial)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="Corpus sizes in pages")
+    parser.add_argument("--only", nargs="+", choices=list(WORKLOADS), help="Run only these workloads")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc pass")
+    parser.add_argument("--output", "-o", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="Baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Allowed slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    baseline_path = Path(args.baseline).resolve()
+    output_path = Path(args.output).resolve() if args.output else None
+
+    font = args.font
+    if font is None:
+        try:
+            from text_metrics.freetype_measurer import resolve_font
+            font = resolve_font("Helvetica") or resolve_font("Arial")
+        except ImportError:
+            pass
+    if FONT_WORKLOADS.intersection(args.only or WORKLOADS) and (font is None or not os.path.isfile(font)):
+        parser.error(f"no font file found for {', '.join(sorted(FONT_WORKLOADS))}; pass --font /path/to/font.ttf"
+                     if font is None else f"font file not found: {font}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as WORKDIR:
+        cwd = os.getcwd()
+        try:
+            for size in args.sizes:
+                paragraphs = corpus(size)
+                results[str(size)] = {name: measure(name, paragraphs, size, font, not args.no_memory)
+                                      for name in (args.only or WORKLOADS)}
+        finally:
+            os.chdir(cwd)
+
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+    if not baseline and not args.save_baseline:
+        print(f"No baseline at {baseline_path}; run again with --save-baseline to record one.", file=sys.stderr)
+    regressions = compare(results, baseline, args.tolerance)
+    report = {
+        "seed": SEED,
+        "words_per_page": WORDS_PER_PAGE,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "font": font,
+        "results": results,
+        "regressions": regressions,
+    }
+
+    print_table(results, regressions)
+    text = json.dumps(report, indent=2)
+    if output_path:
+        output_path.write_text(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        baseline_path.write_text(text)
+    return 1 if regressions and not args.save_baseline else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,23 +1,53 @@
 import enum
+import html
 import os
 import re
+import shutil
 import sys
 import time
+import traceback
 import math
-import uuid
-import lorem
-from layout import TextLayout, convert, pagesizes
-from parser import interpret
+from parser import program, execute
 from typing import Literal, get_type_hints, Union, Tuple
-import freetype
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 
-from text_metrics import TextMetrics
+from linebreak import BreakCache, greedy, optimal, justify
+from instrument import span
+import preview
 
 DPI = 96
+# Page files of chunked output, next to index.html
+CHUNK_DIR = "pages"
+# The PDF written next to index.html when the document's output includes "pdf"
+PDF_FILE = "index.pdf"
+
+# Fetches each chunked page as it nears the viewport, including placeholders the preview inserts later.
+LOADER = """<script>
+(() => {
+  const loader = new IntersectionObserver(entries => {
+    for (const entry of entries) {
+      if (!entry.isIntersecting) continue;
+      const chunk = entry.target;
+      loader.unobserve(chunk);
+      fetch(chunk.dataset.src).then(response => response.text()).then(html => {
+        const template = document.createElement("template");
+        template.innerHTML = html;
+        if (chunk.isConnected) chunk.replaceWith(template.content.firstElementChild);
+      });
+    }
+  }, {rootMargin: "200% 0px"});
+  addEventListener("DOMContentLoaded", () => {
+    document.querySelectorAll(".chunk").forEach(chunk => loader.observe(chunk));
+    new MutationObserver(records => records.forEach(record => record.addedNodes.forEach(node => {
+      if (node.classList && node.classList.contains("chunk")) loader.observe(node);
+    }))).observe(document.body, {childList: true});
+  });
+})();
+</script>
+"""
 
 class Size:
+    __slots__ = ("element",)
+
     def __init__(self, element):
         self.element = element
 
@@ -41,12 +71,21 @@ class Size:
         return f"[{self[0]}, {self[1]}]"
 
 class HTMLElement:
+    __slots__ = ("_tag", "_classname", "_style", "_children", "_id")
+    # Ids come from a counter instead of uuid4 so output is stable across builds; BKM checkpoints it.
+    next_id = 0
+
+    @staticmethod
+    def new_id():
+        HTMLElement.next_id += 1
+        return f"e{HTMLElement.next_id}"
+
     def __init__(self, tag="div", classname="", style=None, content=None, id=None):
         self._tag = tag
         self._classname = classname
         self._style = style if style else {}
         self._children = {}  
-        self._id = id if id else str(uuid.uuid4())
+        self._id = id if id else self.new_id()
 
         if content:
             if isinstance(content, dict):
@@ -95,7 +134,7 @@ class HTMLElement:
         if isinstance(element, bytes):
             element = element.decode("utf-8")
         if isinstance(element, str):
-            child_id = name if name else str(uuid.uuid4())
+            child_id = name if name else self.new_id()
             self._children[child_id] = element
             return child_id
         if isinstance(element, HTMLElement):
@@ -104,10 +143,25 @@ class HTMLElement:
             return element.id
         raise TypeError("Child must be HTMLElement or string")
 
-    def __str__(self):
+    def opening(self):
         style_str = "; ".join(f"{k}: {v}" for k, v in self._style.items())
-        children_str = "".join(str(c) for c in self._children.values())
-        return f'<{self._tag} id="{self._id}" class="{self._classname}" style="{style_str}">{children_str}</{self._tag}>'
+        return f'<{self._tag} id="{self._id}" class="{self._classname}" style="{style_str}">'
+
+    def chunks(self):
+        """Yield the serialized element piece by piece, without building the subtree's string."""
+        yield self.opening()
+        for child in self._children.values():
+            if isinstance(child, HTMLElement):
+                yield from child.chunks()
+            else:
+                yield child
+        yield f'</{self._tag}>'
+
+    def write(self, f):
+        f.writelines(self.chunks())
+
+    def __str__(self):
+        return "".join(self.chunks())
 
     def __repr__(self):
         return str(self)
@@ -121,24 +175,98 @@ class HTMLElement:
 
 # Shortcut classes
 class Div(HTMLElement):
+    __slots__ = ()
+
     def __init__(self, classname="", style=None, content=None, id=None):
         super().__init__("div", classname, style, content, id)
 
 class Body(HTMLElement):
+    __slots__ = ()
+
     def __init__(self, classname="", style=None, content=None, id=None):
         super().__init__("body", classname, style, content, id)
         
 class P(HTMLElement):
+    __slots__ = ()
+
     def __init__(self, classname="", style=None, content=None, id=None):
         super().__init__("p", classname, style, content, id)
 
 
 class BKM:
+    incremental = ("blocks", "checkpoints", "origin")
+
     def __init__(self):
         self.view = Body("view", style={"margin": "0", "display": "grid", "columns": "1", "justify-content": "center", "column-gap": "1px", "row-gap": "50px", "background-color": "#262626"})
         self.spreads = []
-        self.pages: list[HTMLElement] = []
+        self.pages: list[HTMLElement | None] = []
+        # (hash, placeholder) of every page written to its own file; flushed pages are None in self.pages
+        self.chunks: list[tuple[str, str]] = []
+        # Per written page: its id, class, style and the key and length of each child in its file, so a
+        # checkpoint on a flushed page can bring the page back up to that checkpoint's child
+        self.outlines: dict[int, tuple[str, str, dict, list[tuple[str, int]]]] = {}
+        self.chunked = False
+        self.outputs = ("html",)
+        self.canvas = None
         self.settings()
+        self.blocks = []
+        self.checkpoints = []
+        self.origin = self.checkpoint()
+
+    def checkpoint(self):
+        state = {key: value for key, value in vars(self).items() if key not in self.incremental}
+        mark = self.canvas.mark() if state.get("canvas") is not None else None
+        # The view is shared by every checkpoint, so its style, which document() changes, is copied.
+        return state, len(self.pages), len(self.pages[-1].children) if self.pages else 0, HTMLElement.next_id, mark, dict(self.view.style)
+
+    def restore(self, checkpoint):
+        state, pages, children, HTMLElement.next_id, mark, view_style = checkpoint
+        for key in [key for key in vars(self) if key not in self.incremental]:
+            delattr(self, key)
+        vars(self).update(state)
+        self.view.style = dict(view_style)
+        if mark is not None:
+            self.canvas.rewind(mark)
+        del self.pages[pages:]
+        del self.chunks[pages:]
+        if self.pages and self.pages[-1] is None:
+            self.reload(pages - 1, children)
+        elif self.pages:
+            for key in list(self.pages[-1].children)[children:]:
+                del self.pages[-1].children[key]
+
+    def reload(self, index, children):
+        """Bring flushed page `index` back with its first `children` children, read back from its file as HTML."""
+        id, classname, style, outline = self.outlines[index]
+        with open(os.path.join(CHUNK_DIR, f"page-{index + 1}.html"), "r", encoding="utf-8") as f:
+            page_html = f.read()
+        page = Div(classname, dict(style), id=id)
+        position = len(page.opening())
+        for key, length in outline[:children]:
+            page.append(page_html[position:position + length], key)
+            position += length
+        self.pages[index] = page
+
+    def build(self, path):
+        """Interpret `path`, re-running only the blocks from the first one that changed since the last build."""
+        with open(path, "r") as f:
+            blocks = program(f.read(), path)
+
+        start = 0
+        while start < min(len(blocks), len(self.blocks)) and blocks[start] == self.blocks[start]:
+            start += 1
+        if start == len(blocks) == len(self.blocks):
+            return
+
+        if start < len(self.checkpoints):
+            self.restore(self.checkpoints[start])
+        elif start == 0:
+            self.restore(self.origin)
+        del self.checkpoints[start:]
+        for block in blocks[start:]:
+            self.checkpoints.append(self.checkpoint())
+            execute(self, block)
+        self.blocks = blocks
 
     def document(self,
                  unit:      Literal["mm","px","pt","in","ft"] = "mm",
@@ -149,7 +277,11 @@ class BKM:
                  start:     Literal["left","right"] = "right",
                  # margin:    Union[int, float, Tuple[int|float, ...]] = (25,25,30,25),
                  margin:    Tuple[int|float, ...] = (25,25,30,25),
-                 bleed:     Tuple[int|float, ...] = (0,)):
+                 bleed:     Tuple[int|float, ...] = (0,),
+                 measurer:  Literal["playwright","freetype"] = "playwright",
+                 chunked:   bool = False,
+                 output:    Literal["html","pdf","both"] = "html"):
+        from layout import convert, pagesizes
         w, h = pagesizes[size][unit]
         if width is not None: w = width
         if height is not None: h = height
@@ -160,7 +292,14 @@ class BKM:
         self.margin = margin
         self.margin = self.csstuple(margin)
         self.bleed = self.csstuple(bleed)
-
+        self.measurer = measurer
+        self.chunked = chunked
+        self.outputs = ("html", "pdf") if output == "both" else (output,)
+        if "pdf" in self.outputs:
+            # The PDF is drawn from the same line breaks and offsets as the HTML, in points from the bottom left.
+            from display import DisplayList
+            self.canvas = DisplayList(((w + self.bleed[1] + self.bleed[3]) * convert[unit]["pt"],
+                                       (h + self.bleed[0] + self.bleed[2]) * convert[unit]["pt"]))
 
         if self.spread:
             self.view.style["grid-template-columns"] = "repeat(2, max-content)"
@@ -187,11 +326,54 @@ class BKM:
     # LEFT / RIGHT VARIABLES FOR EACH PAGE    
     # INNER / OUTER MARGIN
     def page(self):
-        page = Div("page", style={"width": f"{self.size[0]+self.bleed[1]+self.bleed[3]}{self.unit}", "height": f"{self.size[1]+self.bleed[0]+self.bleed[2]}{self.unit}", "background-color": "white", "position": "relative", "padding": " ".join([f"{m+self.bleed[i]}{self.unit}" for i, m in enumerate(self.margin)]), "box-sizing": "border-box", "line-height": "1.2"})
+        from layout import convert
+        if self.chunked and self.pages:
+            self.flush(len(self.pages) - 1)
+        page = Div("page")
+        if not self.pages and self.spread and self.start == "right":
+            page.style["grid-column"] = "2"
+        if self.canvas is not None and self.pages:
+            self.canvas.showPage()
         self.pages.append(page)
         self.cursor_y = (self.margin[0]+self.bleed[0]) * convert[self.unit]["px"]
 
-    def paragraph(self, content: str, width: float = 1.0, font: tuple[str,int] = ("Helvetica", 16)):
+    def flush(self, index, free=True):
+        """Write page `index` to its own file (unless it's unchanged since it was last written) and, with `free`, drop its tree."""
+        page = self.pages[index]
+        children = [(key, str(child)) for key, child in page.children.items()]
+        page_html = page.opening() + "".join(text for _, text in children) + "</div>"
+        digest = preview.digest(page_html)
+        if index >= len(self.chunks) or self.chunks[index][0] != digest:
+            self.outlines[index] = (page.id, page.classname, dict(page.style), [(key, len(text)) for key, text in children])
+            os.makedirs(CHUNK_DIR, exist_ok=True)
+            with open(os.path.join(CHUNK_DIR, f"page-{index + 1}.html"), "w", encoding="utf-8") as f:
+                f.write(page_html)
+            style = "; ".join(f"{k}: {v}" for k, v in page.style.items())
+            placeholder = f'<div id="{page.id}" class="page chunk" style="{style}" data-src="{CHUNK_DIR}/page-{index + 1}.html?{digest}"></div>'
+            del self.chunks[index:]
+            self.chunks.append((digest, placeholder))
+        if free:
+            self.pages[index] = None
+
+    def stylesheet(self):
+        """Page box and guides, written once as shared rules instead of repeated on every page."""
+        width = f"{self.size[0]+self.bleed[1]+self.bleed[3]}{self.unit}"
+        height = f"{self.size[1]+self.bleed[0]+self.bleed[2]}{self.unit}"
+        padding = " ".join([f"{m+self.bleed[i]}{self.unit}" for i, m in enumerate(self.margin)])
+        rules = [f".page {{ width: {width}; height: {height}; background-color: white; position: relative; padding: {padding}; box-sizing: border-box; line-height: 1.2; }}",
+                 # Lines are broken by BKM, the browser only spaces them out.
+                 ".line { display: block; white-space: nowrap; text-align-last: justify; }",
+                 ".line.last { text-align-last: auto; }"]
+        if self.guides:
+            rules.append(".page::before, .page::after { content: \"\"; position: absolute; pointer-events: none; }")
+            rules.append(f".page::before {{ outline: 1px solid blue; inset: {' '.join([f'{m+self.bleed[i]}mm' for i, m in enumerate(self.margin)])}; }}")
+            rules.append(f".page::after {{ outline: 1px solid darkgrey; inset: {' '.join([f'{b}mm' for b in self.bleed])}; }}")
+        if self.chunked:
+            rules.append(".page { content-visibility: auto; }")
+        return "\n".join(rules) + "\n"
+
+    def paragraph(self, content: str, width: float = 1.0, font: tuple[str,int] = ("Helvetica", 16),
+                  linebreak: Literal["greedy","optimal"] = "greedy"):
         default_width = self.size[0] - self.margin[1] - self.margin[3]
         if width == 1.0:
             width = default_width
@@ -200,104 +382,199 @@ class BKM:
         elif width < 0:
             width += default_width
 
-        # words = re.findall(r'\S+\s*', content)
+        from layout import convert
+        from text_metrics.freetype_measurer import resolve_font
         words = content.split()
+        max_width = width * convert[self.unit]["px"]
 
-        text_metrics = TextMetrics(font)
+        # The font file is part of the key, so installing another version of the font re-measures.
+        path = resolve_font(font[0], scan=self.measurer == "freetype")
+        key = BreakCache.key("bkm", content, font, path, os.path.getmtime(path) if path else None, max_width, self.measurer, linebreak)
+        cached = BreakCache.get(key)
+        if cached is None:
+            ends, line_height, offsets = self.breaklines(words, font, max_width, linebreak)
+            BreakCache.put(key, ends, [line_height, *offsets])
+        else:
+            ends, (line_height, *offsets) = cached
+
+        # Lines go below the cursor while they fit on the page; the rest of the paragraph continues on the next page.
+        top = (self.margin[0] + self.bleed[0]) * convert[self.unit]["px"]
+        bottom = (self.size[1] + self.bleed[0] - self.margin[2]) * convert[self.unit]["px"]
+        with span("paginate"):
+            lines = []
+            start = 0
+            for i, end in enumerate(ends):
+                if self.cursor_y + line_height > bottom and self.cursor_y > top:
+                    self.setlines(lines, width, font, line_height)
+                    lines = []
+                    self.page()
+                lines.append((" ".join(words[start:end]), i == len(ends) - 1))
+                if self.canvas is not None:
+                    self.drawline(words[start:end], offsets[start:end], font, path, line_height)
+                self.cursor_y += line_height
+                start = end
+            self.setlines(lines, width, font, line_height)
+
+    def setlines(self, lines, width, font, line_height):
+        """Add a paragraph of (text, last) lines, already broken, to the current page.
+
+        The line height is set explicitly, so the browser stacks the lines exactly as pagination counted them.
+        """
+        if not lines:
+            return
+        content = " ".join(f'<span class="line{" last" if last else ""}">{html.escape(text)}</span>' for text, last in lines)
+        self.pages[-1].append(P(classname="paragraph",
+                                style={"margin-top": "0",
+                                       "margin-bottom": "0",
+                                       "width": f"{width}{self.unit}",
+                                       "font-family": font[0],
+                                       "font-size": f"{font[1]}pt",
+                                       "line-height": f"{line_height}px",
+                                       "text-align": "justify"},
+                                content=content))
+
+    def drawline(self, words, offsets, font, path, line_height):
+        """Draw one line at the cursor into the PDF display list, its words at the offsets the HTML justifies them to."""
+        from reportlab.pdfbase import pdfmetrics
+        from layout import convert
+        from text_metrics.freetype_measurer import line_metrics, points
+        import fonts
+        name = font[0].strip("\"'")
+        if name not in pdfmetrics.standardFonts:
+            if path is None:
+                name = "Helvetica"
+            elif name not in fonts.FONTS:
+                fonts.declare(name, path)
+        size = points(font[1])
+        # CSS centres the font's ascender and descender in the line box.
+        if path is not None:
+            ascender, descender, _ = line_metrics(path)
+            baseline = (line_height - (ascender + descender) * size * DPI / 72) / 2 + ascender * size * DPI / 72
+        else:
+            baseline = 0.8 * line_height
+        scale = convert["px"]["pt"]
+        x = (self.margin[3] + self.bleed[3]) * convert[self.unit]["pt"]
+        y = self.canvas.pagesize[1] - (self.cursor_y + baseline) * scale
+        self.canvas.setFont(name, size)
+        if len(words) == 1:
+            self.canvas.drawString(x, y, words[0])
+        else:
+            self.canvas.drawWords([(x + offset * scale, y, word) for word, offset in zip(words, offsets)])
+
+    def breaklines(self, words, font, max_width, linebreak="greedy"):
+        """Measure `words` and break them as Document does; returns line ends, the line height and every word's offset in its line."""
+        from text_metrics import TextMetrics
+        text_metrics = TextMetrics(font, self.measurer)
         word_widths, space_width = text_metrics.measure_words(words)
         line_height = text_metrics.line_height()
+        widths = [word_widths[word] for word in words]
 
-        line_length = 0
-        lines = []
-        line = []
-        height = 0
-        split = []
-
-        max_width = width * convert[self.unit]["px"]
-        max_height = (self.size[1] - self.margin[0] - self.margin[2]) * convert[self.unit]["px"]
-        for word in words:
-            word_width = word_widths[word]
-            line_length += word_width + space_width
-            if line_length - space_width <= max_width:
-                line.append(word)
-            else:
-                height += line_height
-                if height > max_height:
-                    height = line_height
-                    split.append(" ".join(lines))
-                    lines = []
-                lines.append(" ".join(line))
-                print(lines[-1])
-                line = [word]
-                line_length = word_width + space_width
-        lines.append(" ".join(line))
-        split.append(" ".join(lines))
-
-        for i, text in enumerate(split):
-            paragraph = P(classname="paragraph",
-                          style={"margin-top": "0",
-                                 "margin-bottom": "0",
-                                 "width": f"{width}{self.unit}",
-                                 "font-family": font[0],
-                                 "font-size": f"{font[1]}pt",
-                                 "text-align": "justify"},
-                          content=text)
-            self.pages[-1].append(paragraph)
-            if i < len(split)-1:
-                self.page()
-        self.cursor_y += height
-        print(self.cursor_y)
+        with span("line-break"):
+            lines = {"greedy": greedy, "optimal": optimal}[linebreak](widths, max_width, space_width)
+        return [end for _, end in lines], line_height, justify(widths, lines, max_width, space_width)
 
     def lorem(self, paragraphs=1, width=1):
+        import lorem
         for i in range(paragraphs):
             self.paragraph(lorem.paragraph(), width)
 
     def write(self):
-        if self.spread and self.start == "right":
-            self.pages[0].style["grid-column"] = "2"
-
-        if self.guides:
-            for page in self.pages:
-                page.append(Div("guide", {"position": "absolute", "outline": "1px solid blue", "inset": " ".join([f"{m+self.bleed[i]}mm" for i, m in enumerate(self.margin)])}))
-                page.append(Div("guide", {"position": "absolute", "outline": "1px solid darkgrey", "inset": " ".join([f"{b}mm" for b in self.bleed])}))
-
-        for page in self.pages:
-            self.view.append(page)
-
         html_start = """<!DOCTYPE html>
     <html lang="en">
     <head>
         <meta charset="UTF-8">
-        <script src="http://localhost:1234/livereload.js"></script>
-    </head>
     """
 
         html_end = """
     </html>
     """
 
-        # Convert the Body object to string safely
-        body_content = str(self.view)
-
-        with open("index.html", "w", encoding="utf-8") as f:
-            f.write(html_start + body_content + html_end)
+        if "pdf" in self.outputs:
+            import display
+            display.write(self.canvas, PDF_FILE)
+        if "html" in self.outputs:
+            with span("serialize"):
+                if self.chunked:
+                    # Pages still in memory are written too, but kept: later blocks may add to the last one.
+                    for index, page in enumerate(self.pages):
+                        if page is not None:
+                            self.flush(index, free=False)
+                    pages = [placeholder for _, placeholder in self.chunks]
+                    stale = len(pages) + 1
+                    while os.path.exists(path := os.path.join(CHUNK_DIR, f"page-{stale}.html")):
+                        os.remove(path)
+                        stale += 1
+                else:
+                    pages = self.pages
+                stylesheet = self.stylesheet()
+
+                # Each page is hashed as it streams into a body file, and only its digest is kept. The head, which
+                # lists the digests, is written once they are all known, followed by a copy of the body file.
+                # With a preview server running, the page's HTML is kept too: browsers may ask for it from a server
+                # thread at any time, including while the next build is changing the pages in place.
+                tmp = f"index.html.{os.getpid()}"
+                hashes = []
+                texts = {}
+                with open(tmp + ".body", "w+", encoding="utf-8") as body:
+                    for page in pages:
+                        digest = preview.hasher()
+                        parts = [] if preview.server is not None else None
+                        for chunk in page.chunks() if isinstance(page, HTMLElement) else (page,):
+                            digest.update(chunk.encode("utf-8"))
+                            body.write(chunk)
+                            if parts is not None:
+                                parts.append(chunk)
+                        hashes.append(digest.hexdigest())
+                        if parts is not None:
+                            texts[hashes[-1]] = "".join(parts)
+                    body.seek(0)
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.write(html_start)
+                        f.write(preview.script())
+                        if self.chunked:
+                            f.write(LOADER)
+                        f.write(f'<style id="preview-style">\n{stylesheet}</style>\n')
+                        f.write(preview.state(hashes))
+                        f.write("</head>\n")
+                        f.write(self.view.opening())
+                        shutil.copyfileobj(body, f)
+                        f.write("</body>")
+                        f.write(html_end)
+                os.remove(tmp + ".body")
+                os.replace(tmp, "index.html")
+
+            preview.publish(hashes, texts.__getitem__, stylesheet)
+
+        if "text_metrics" in sys.modules:
+            from text_metrics.cache_manager import WordCacheManager
+            WordCacheManager.save_cache()
+        BreakCache.save()
 
         print("write")
 
 
 
-class FileWatcher(FileSystemEventHandler):
-    def __init__(self, path):
+class FileWatcher:
+    """A watchdog event handler. Observers only call dispatch(), so watchdog itself is imported by loop() alone."""
+    def __init__(self, path, rebuild):
         self.path = path
+        self.rebuild = rebuild
+
+    def dispatch(self, event):
+        if event.event_type == "modified":
+            self.on_modified(event)
 
     def on_modified(self, event):
         if event.src_path.endswith(self.path):
-            python = sys.executable
-            os.execv(python, [python] + sys.argv)
+            try:
+                self.rebuild()
+            except Exception:
+                traceback.print_exc()
 
-def loop(path):
+def loop(path, rebuild):
+    from watchdog.observers import Observer
     observer = Observer()
-    observer.schedule(FileWatcher(path), path=os.path.dirname(os.path.abspath(path)) or ".", recursive=False)
+    observer.schedule(FileWatcher(path, rebuild), path=os.path.dirname(os.path.abspath(path)) or ".", recursive=False)
     observer.start()
 
     try:
@@ -308,8 +585,8 @@ def loop(path):
     observer.join()
 
 if __name__ == "__main__":
-    with open("document.bkm", "r") as f:
-        interpret(BKM(), f.read())
+    bkm = BKM()
+    bkm.build("document.bkm")
     # with open("index.html", "r") as f:
     #     print(f.read())
-    loop("document.bkm")
+    loop("document.bkm", lambda: bkm.build("document.bkm"))
@@ -1,30 +1,21 @@
 from reportlab.lib.pagesizes import *
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfgen import canvas
 import re
 import inspect
 from typing import Literal
 import os, sys
 import getpass
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 import time
-import lorem
+import traceback
+import math
+import importlib.util
+import hashlib
+from linebreak import greedy, optimal, justify, BreakCache
+from instrument import span, warn
+from display import DisplayList, write
+from fonts import FONTS, declare, segment
 
 
-EMOJI_PATTERN = re.compile(
-    "[" 
-    "\U0001F300-\U0001F5FF"  # symbols & pictographs
-    "\U0001F600-\U0001F64F"  # emoticons
-    "\U0001F680-\U0001F6FF"  # transport & map symbols
-    "\U0001F700-\U0001F77F"  # alchemical symbols
-    "\U0001F900-\U0001F9FF"  # supplemental symbols
-    "\U00002600-\U000026FF"  # misc symbols 
-    "\U00002700-\U000027BF"  # dingbats
-    "]+",
-    flags=re.UNICODE
-)
+STREAM_LIMIT = 1 << 16
 
 
 class BookmarkError(Exception):
@@ -33,14 +24,22 @@ class BookmarkError(Exception):
         super().__init__(f"[{field}] {message}")
 
 
-class FileWatcher(FileSystemEventHandler):
-    def __init__(self, path):
+class FileWatcher:
+    """A watchdog event handler. Observers only call dispatch(), so watchdog itself is imported by loop() alone."""
+    def __init__(self, path, rebuild):
         self.path = path
+        self.rebuild = rebuild
+
+    def dispatch(self, event):
+        if event.event_type == "modified":
+            self.on_modified(event)
 
     def on_modified(self, event):
         if event.src_path.endswith(self.path):
-            python = sys.executable
-            os.execv(python, [python] + sys.argv)
+            try:
+                self.rebuild()
+            except Exception:
+                traceback.print_exc()
 
 
 class Font(str):
@@ -50,25 +49,77 @@ class Font(str):
 
 
 class Document:
-    def __init__(self, path:str=sys.argv[1]) -> None:
-        self.path = path
+    incremental = ("parser", "blocks", "checkpoints", "origin")
+
+    def __init__(self, path:str|None=None) -> None:
+        self.path = sys.argv[1] if path is None else path
         self.parser = Parser(self)
+        self.blocks = []
+        self.checkpoints = []
+        self.origin = self.checkpoint()
         if os.path.isdir(self.path):
             print("structure")
         elif os.path.isfile(self.path):
             with open(self.path, "r") as f:
-                self.parser.parse(f.readlines())
-            self.canvas.save()
+                self.layout(self.parser.parse(f))
+            self.write()
             # os.system(f"open {self.filename}")
         else:
             raise BookmarkError("Document.path", f"No such file or directory: {self.path}")
 
-    def document(self, title:str="Document", author:str=getpass.getuser(), size:Literal["A1","A2","A3","A4","A5","A6","A7","A8","A9","A10"]="A4"):
+    def checkpoint(self):
+        state = {key: value for key, value in vars(self).items() if key not in self.incremental}
+        return state, self.canvas.mark() if "canvas" in state else None
+
+    def restore(self, checkpoint):
+        state, mark = checkpoint
+        for key in [key for key in vars(self) if key not in self.incremental]:
+            delattr(self, key)
+        vars(self).update(state)
+        if mark is not None:
+            self.canvas.rewind(mark)
+
+    def layout(self, blocks):
+        """Dispatch `blocks` after those already laid out, keeping a checkpoint before each and its signature after."""
+        for block in blocks:
+            self.checkpoints.append(self.checkpoint())
+            self.parser.dispatch(block)
+            self.blocks.append(signature(block))
+
+    def rebuild(self):
+        """Re-parse the source and lay out again from the first block that changed since the last layout."""
+        with open(self.path, "r") as f, span("parse"):
+            blocks = list(self.parser.blocks(f))
+        signatures = [signature(block) for block in blocks]
+
+        start = 0
+        while start < min(len(signatures), len(self.blocks)) and signatures[start] == self.blocks[start]:
+            start += 1
+        if start == len(signatures) == len(self.blocks):
+            return
+
+        # Blocks only appended after the last one continue from where layout stopped.
+        if start < len(self.checkpoints):
+            self.restore(self.checkpoints[start])
+        del self.checkpoints[start:]
+        del self.blocks[start:]
+        self.layout(blocks[start:])
+        self.write()
+
+    def write(self):
+        write(self.canvas, self.filename, self.outputs, self.jobs)
+        BreakCache.save()
+
+    def document(self, title:str="Document", author:str=getpass.getuser(), size:Literal["A1","A2","A3","A4","A5","A6","A7","A8","A9","A10"]="A4", jobs:int=1, output:Literal["pdf","html","both"]="pdf"):
+        if jobs > 1 and output != "html" and importlib.util.find_spec("pypdf") is None:
+            raise BookmarkError("Document.jobs", "Rendering with several jobs needs pypdf to merge the parts")
         self.filename = "output.pdf"
+        self.outputs = ("pdf", "html") if output == "both" else (output,)
+        self.jobs = jobs
         self.title = title
         self.author = author
         self.pagesize = {"A1":A1,"A2":A2,"A3":A3,"A4":A4,"A5":A5,"A6":A6,"A7":A7,"A8":A8,"A9":A9,"A10":A10}[size]
-        self.canvas = canvas.Canvas(self.filename, self.pagesize)
+        self.canvas = DisplayList(self.pagesize)
         self.margin = (0, 0, 0, 0)
         self.font = Font("Helvetica")
         self.font.bold = "Helvetica"
@@ -76,6 +127,8 @@ class Document:
         self.font.size = 12
         self.initfont("Zapf", "~/Library/Fonts/Zapf Dingbats Regular.ttf")
         self.initfont("Emoji", "~/Library/Fonts/NotoEmoji-Regular.ttf")
+        self.fallbacks = ("Emoji",)
+        self.masterpage = None
         self.cursor_y = self.pagesize[1]
 
     def setmargin(self, top=None, right=None, bottom=None, left=None, vertical=None, horizontal=None, all=None):
@@ -98,7 +151,40 @@ class Document:
         self.cursor_y = self.pagesize[1] - self.margin[0]
 
     def initfont(self, name: str, path: str):
-        pdfmetrics.registerFont(TTFont(name, os.path.expanduser(path)))
+        declare(name, path)
+
+    def fallback(self, fonts="Emoji"):
+        """Comma-separated fonts to draw characters the current font has no glyphs for, tried in order."""
+        self.fallbacks = tuple(name.strip() for name in fonts.split(",") if name.strip())
+
+    def textwidth(self, text):
+        runs = segment(text, (str(self.font), *self.fallbacks))
+        if len(runs) == 1:
+            return self.canvas.stringWidth(text, runs[0][0], self.font.size)
+        return sum(self.canvas.stringWidth(run, font, self.font.size) for font, run in runs)
+
+    def drawtext(self, x, y, text):
+        """drawString that switches to a fallback font once per run of characters the current font can't draw."""
+        runs = segment(text, (str(self.font), *self.fallbacks))
+        if len(runs) == 1 and runs[0][0] == self.font:
+            self.canvas.drawString(x, y, text)
+            return
+        for font, run in runs:
+            self.canvas.setFont(font, self.font.size)
+            self.canvas.drawString(x, y, run)
+            x += self.canvas.stringWidth(run, font, self.font.size)
+        self.canvas.setFont(self.font, self.font.size)
+
+    def drawwords(self, words):
+        """Draw a justified line of (x, y, word) as one text object, unless some word needs a fallback font."""
+        chain = (str(self.font), *self.fallbacks)
+        for _, _, word in words:
+            runs = segment(word, chain)
+            if len(runs) > 1 or runs[0][0] != self.font:
+                for data in words:
+                    self.drawtext(*data)
+                return
+        self.canvas.drawWords(words)
 
     def setfont(self, name: str|Font, size: int=12, bold=None, italic=None):
         if isinstance(name, Font):
@@ -111,10 +197,42 @@ class Document:
         self.canvas.setFont(self.font, self.font.size)
 
     def newpage(self):
+        if self.canvas.form is not None:
+            raise BookmarkError("Document.newpage", f"Master page {self.canvas.form!r} has to fit on one page; end it with endmaster() first")
         self.canvas.showPage()
         self.setfont(self.font)
+        if self.masterpage is not None:
+            self.canvas.doForm(self.masterpage)
         self.cursor_y = self.pagesize[1]-self.margin[0]
 
+    def master(self, name="default"):
+        """Draw what follows, until endmaster(), into a master page that is stored once and placed by usemaster()."""
+        if self.canvas.form is not None:
+            raise BookmarkError("Document.master", f"Master page {self.canvas.form!r} isn't finished; end it with endmaster() first")
+        self.canvas.beginForm(name)
+        self.canvas.setFont(self.font, self.font.size)
+        # Text in the master page moves the cursor; the page around it carries on from where it was.
+        self.formcursor = self.cursor_y
+
+    def endmaster(self):
+        if self.canvas.form is None:
+            raise BookmarkError("Document.endmaster", "No master page was started")
+        self.canvas.endForm()
+        self.cursor_y = self.formcursor
+
+    def usemaster(self, name="default"):
+        """Place master page `name` under every following page, and under this one if nothing is drawn on it yet;
+        an empty name stops placing it."""
+        if name and name not in self.canvas.forms:
+            raise BookmarkError("Document.usemaster", f"No master page named {name!r}")
+        self.masterpage = name or None
+        if self.masterpage is not None and not self.canvas.pages[-1].items:
+            self.canvas.doForm(self.masterpage)
+
+    def pagenumber(self, x=0, y=0, format="{page}"):
+        """Draw text filled in per page, where {page} is the page number and {pages} the page count."""
+        self.canvas.drawField(x, y, format)
+
     def heading(self, text="Heading", level=2):
         text = text.replace("\n","")
         fontsize = {1: 24, 2: 18, 3: 14}[level]
@@ -129,8 +247,9 @@ class Document:
 
         self.canvas.setFont(self.font, self.font.size)
 
-    def paragraph(self, text=None, leading=None, spacing=1):
+    def paragraph(self, text=None, leading=None, spacing=1, linebreak:Literal["greedy","optimal"]="greedy"):
         if text == None:
+            import lorem
             text = lorem.paragraph()
         if leading is None:
             leading = int(self.font.size * 1.2)
@@ -138,31 +257,44 @@ class Document:
         if self.cursor_y == self.pagesize[1] - self.margin[0]:
             self.cursor_y -= leading
 
-        pages = self.justifytext(text)
-        for i, page in enumerate(pages):
-            for line in page:
-                for data in line:
-                    self.canvas.drawString(*data)
-                    self.cursor_y = data[1]
-            if i < len(pages)-1:
+        for i, page in enumerate(self.justify(text, linebreak=linebreak)):
+            if i > 0:
                 self.newpage()
+            with span("draw"):
+                for line in page:
+                    if len(line) > 1:
+                        self.drawwords(line)
+                    else:
+                        self.drawtext(*line[0])
+                    self.cursor_y = line[-1][1]
 
         self.cursor_y -= spacing*leading
 
-    def justifytext(self, text, leading=None):
+    def justifytext(self, text, leading=None, linebreak:Literal["greedy","optimal"]="greedy", indices=False):
+        return list(self.justify(text, leading, linebreak, indices))
+
+    def justify(self, text, leading=None, linebreak:Literal["greedy","optimal"]="greedy", indices=False):
+        """Yield justified pages one at a time. `text` may be a string or an iterable of lines.
+
+        With `indices`, every word is emitted on its own as (x, y, word, index), where index
+        counts the words of `text` from 0, so callers can map positions back to their source.
+        """
         if leading is None:
             leading = int(self.font.size * 1.2)
+        breaker = {"greedy": greedy, "optimal": optimal}[linebreak]
 
         x = self.margin[3]
         y = self.cursor_y - leading
         width = self.pagesize[0] - self.margin[3] - self.margin[1]
         space_base = self.canvas.stringWidth(" ", self.font, self.font.size)
+        path = FONTS.get(self.font)
+        font = (str(self.font), self.font.size, path, os.path.getmtime(path) if path else None, self.fallbacks)
 
-        justified = []
         justified_page = []
         justified_line = []
+        index = 0
 
-        for raw_line in text.split("\n"):
+        for raw_line in text.split("\n") if isinstance(text, str) else text:
             words = raw_line.split()
 
             if not words:
@@ -171,49 +303,51 @@ class Document:
             else:
                 words[0] = " "*raw_line.find(words[0]) + words[0]
 
-            lines, current_line, current_width = [], [], 0
-            for word in words:
-                w = self.canvas.stringWidth(word, self.font, self.font.size)
-                test_width = current_width + (space_base if current_line else 0) + w
-                if test_width <= width:
-                    current_line.append(word)
-                    current_width = test_width
-                else:
-                    lines.append(current_line)
-                    current_line, current_width = [word], w
-            if current_line:
-                lines.append(current_line)
-
-            for i, line in enumerate(lines):
-                if len(line) == 1 or i == len(lines) - 1:
-                    justified_line.append((x, y, " ".join(line)))
-                else:
-                    word_widths = [self.canvas.stringWidth(w, self.font, self.font.size) for w in line]
-                    total_words_width = sum(word_widths)
-                    gaps = len(line) - 1
-                    natural_space = gaps * space_base
-                    extra_space = (width - total_words_width - natural_space) / gaps
-                    cursor = x
-                    for j, w in enumerate(line):
-                        justified_line.append((cursor, y, w))
-                        cursor += word_widths[j]
-                        if j < gaps:
-                            cursor += space_base + extra_space
-                justified_page.append(justified_line)
-                justified_line = []
-                if y - leading < self.margin[2]:
-                    y = self.pagesize[1]-self.margin[0]
-                    justified.append(justified_page)
-                    justified_page = []
-                y -= leading
-
-        if justified_page != []: justified.append(justified_page)
-
-        return justified
-
+            key = BreakCache.key(raw_line, font, width, linebreak)
+            cached = BreakCache.get(key)
+            if cached is None:
+                ends, offsets = self.breaklines(words, width, space_base, breaker)
+                BreakCache.put(key, ends, offsets)
+            else:
+                ends, offsets = cached
+
+            # Pages filled by this line are yielded after the span, so it doesn't time the consumer.
+            full = []
+            with span("paginate"):
+                start = 0
+                for i, end in enumerate(ends):
+                    ragged = end - start == 1 or i == len(ends) - 1
+                    if ragged and not indices:
+                        justified_line.append((x, y, " ".join(words[start:end])))
+                    else:
+                        for j in range(start, end):
+                            word = (x + offsets[j], y, words[j])
+                            justified_line.append(word + (index + j,) if indices else word)
+                    start = end
+                    justified_page.append(justified_line)
+                    justified_line = []
+                    if y - leading < self.margin[2]:
+                        y = self.pagesize[1]-self.margin[0]
+                        full.append(justified_page)
+                        justified_page = []
+                    y -= leading
+            index += len(words)
+            yield from full
+
+        if justified_page != []: yield justified_page
+
+
+    def breaklines(self, words, width, space_base, breaker):
+        """Measure each word once and break; returns line end indices and the offset of every word from its line start."""
+        with span("measure"):
+            widths = [self.textwidth(word) for word in words]
+        with span("line-break"):
+            lines = breaker(widths, width, space_base)
+        return [end for _, end in lines], justify(widths, lines, width, space_base)
 
     def paragraphdata(self, text=None, leading=None, spacing=1):
         if text == None:
+            import lorem
             text = lorem.paragraph()
         if leading is None:
             leading = int(self.font.size * 1.2)
@@ -239,7 +373,7 @@ class Document:
 
     def list(self, text="", leading=None):
         default_font = self.font
-        symbol_width = pdfmetrics.stringWidth(chr(111), "Zapf", 12)
+        symbol_width = self.canvas.stringWidth(chr(111), "Zapf", 12)
         indent = "       "
         if leading is None:
             leading = int(self.font.size * 1.2)
@@ -274,6 +408,85 @@ class Document:
         self.canvas.rect(x, y, width, height, stroke, fill)
 
 
+class Body:
+    """The lines of one block body, read lazily from the source until the next command line."""
+    def __init__(self, lines, first=""):
+        self.lines = lines
+        self.buffer = [first] if first else []
+        self.next = None
+        self.closed = False
+        # Hash of the lines read so far, as digest(self.text()) would compute it; an empty line is held back
+        # until a later one arrives, since text() drops a trailing one.
+        self.hash = hashlib.blake2b(digest_size=16)
+        self.hashed = 0
+        self.held = False
+        if first:
+            self.feed(first)
+
+    def readline(self):
+        line = next(self.lines, None)
+        if line is None or line.startswith(";"):
+            self.closed = True
+            self.next = line
+            return None
+        line = line.rstrip()
+        self.feed(line)
+        return line
+
+    def feed(self, line):
+        if self.held:
+            self.hash.update(b"\n" if self.hashed else b"")
+            self.hashed += 1
+        self.held = line == ""
+        if not self.held:
+            self.hash.update((("\n" if self.hashed else "") + line).encode("utf-8"))
+            self.hashed += 1
+
+    def fill(self, limit=math.inf):
+        """Buffer lines until the body closes or holds `limit` characters. Returns whether it closed."""
+        size = sum(len(line) for line in self.buffer)
+        while not self.closed and size < limit:
+            line = self.readline()
+            if line is not None:
+                self.buffer.append(line)
+                size += len(line)
+        return self.closed
+
+    def text(self):
+        buffer = self.buffer[:-1] if self.buffer[-1] == "" else self.buffer
+        return "\n".join(buffer)
+
+    def __iter__(self):
+        buffer, self.buffer = self.buffer, []
+        yield from buffer
+        while not self.closed:
+            line = self.readline()
+            if line is not None:
+                yield line
+
+    def drain(self):
+        for _ in self:
+            pass
+
+    def digest(self):
+        """Digest of the whole body, reading whatever is left of it."""
+        self.drain()
+        return self.hash.hexdigest()
+
+
+def digest(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+def signature(block):
+    """What a later rebuild compares a block by: its command and arguments and a digest of its body."""
+    cmd, args, body = block
+    if isinstance(body, Body):
+        body = body.digest()
+    elif body is not None:
+        body = digest(body)
+    return cmd, args, body
+
+
 """
 Rewrite Parser to handle args better 
 """
@@ -282,6 +495,7 @@ class Parser:
         self.doc = doc
 
         self.methods = {name: method for name, method in inspect.getmembers(type(self.doc), predicate=inspect.isfunction)}
+        self.streaming = {"paragraph"}
 
     def parse_args(self, arg_str):
         if not arg_str:
@@ -306,66 +520,87 @@ class Parser:
 
         return args
 
-    def parse(self, lines):
-        current_command = None
-        current_args = {}
-        buffer = []
+    def command(self, line):
+        is_block = ":" in line
+        parts = line[1:].split("(", 1)
+        cmd = parts[0].strip()
+
+        arg_str = ""
+        content_after_colon = ""
+        if len(parts) > 1:
+            rest = parts[1]
+            if is_block:
+                if "):" in rest:
+                    arg_str, after = rest.split("):", 1)
+                    content_after_colon = after.strip()
+                elif rest.endswith(":"):
+                    arg_str = rest[:-1]
+                else:
+                    arg_str = rest.rstrip(")")
+            else:
+                arg_str = rest.rstrip(")")
 
-        for line in lines:
-            line = line.rstrip()
+        return cmd, is_block, arg_str, content_after_colon
 
-            if line.startswith(";"):
-                if current_command and buffer:
-                    if buffer[-1] == "": buffer.pop()
-                    getattr(self.doc, current_command)("\n".join(buffer), **current_args)
-                    buffer = []
-                    current_args = {}
-                    current_command = None
-
-                is_block = ":" in line
-                parts = line[1:].split("(", 1)
-                cmd = parts[0].strip()
-
-                if cmd not in self.methods:
-                    continue
-
-                arg_str = ""
-                content_after_colon = ""
-                if len(parts) > 1:
-                    rest = parts[1]
-                    if is_block:
-                        if "):" in rest:
-                            arg_str, after = rest.split("):", 1)
-                            content_after_colon = after.strip()
-                        elif rest.endswith(":"):
-                            arg_str = rest[:-1]
-                        else:
-                            arg_str = rest.rstrip(")")
-                    else:
-                        arg_str = rest.rstrip(")")
+    def blocks(self, lines, stream=False):
+        """Yield (command, args, body) as soon as each command closes; body is None for commands without a colon.
 
-                current_args = self.parse_args(arg_str)
+        With `stream`, a body of a streaming command that grows past STREAM_LIMIT characters is
+        yielded as a Body that reads the rest of its lines lazily from `lines`.
+        """
+        lines = iter(lines)
+        line = next(lines, None)
 
-                if is_block:
-                    current_command = cmd
-                    if content_after_colon:
-                        buffer.append(content_after_colon)
-                else:
-                    getattr(self.doc, cmd)(**current_args)
-                    current_command = None
+        while line is not None:
+            line = line.rstrip()
+            if not line.startswith(";"):
+                line = next(lines, None)
+                continue
+
+            cmd, is_block, arg_str, content_after_colon = self.command(line)
+            if cmd not in self.methods:
+                warn(f"ignoring unknown function: {cmd}")
+                line = next(lines, None)
+                continue
+
+            args = self.parse_args(arg_str)
+            if not is_block:
+                yield cmd, args, None
+                line = next(lines, None)
                 continue
 
-            if current_command:
-                buffer.append(line)
+            body = Body(lines, content_after_colon)
+            if stream and cmd in self.streaming and not body.fill(STREAM_LIMIT):
+                yield cmd, args, body
+                body.drain()
+            elif body.fill():
+                if body.buffer:
+                    yield cmd, args, body.text()
+            line = body.next
+
+    def dispatch(self, block):
+        cmd, args, body = block
+        with span(cmd, "command"):
+            if body is None:
+                getattr(self.doc, cmd)(**args)
+            else:
+                getattr(self.doc, cmd)(body, **args)
 
-        if current_command and buffer:
-            if buffer[-1] == "": buffer.pop()
-            getattr(self.doc, current_command)("\n".join(buffer), **current_args)
+    def parse(self, lines):
+        """Yield the blocks of `lines`, streaming long bodies; time spent reading each one counts as parsing."""
+        blocks = self.blocks(lines, stream=True)
+        while True:
+            with span("parse"):
+                block = next(blocks, None)
+            if block is None:
+                return
+            yield block
 
 
-def loop(path):
+def loop(path, rebuild):
+    from watchdog.observers import Observer
     observer = Observer()
-    observer.schedule(FileWatcher(path), path=os.path.dirname(os.path.abspath(path)) or ".", recursive=False)
+    observer.schedule(FileWatcher(path, rebuild), path=os.path.dirname(os.path.abspath(path)) or ".", recursive=False)
     observer.start()
 
     try:
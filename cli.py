@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Command-line entry point: build a document once, watch it and rebuild on save (optionally with a live preview), or measure words with a font.
+
+Backends are imported by the command that needs them, so --help and small builds don't pay for the others.
+"""
+
+import argparse
+import importlib
+import sys
+import time
+
+START = time.perf_counter()
+# Seconds from process start until a command begins running, imports included
+BUDGET = 1.0
+IMPORTS: dict[str, float] = {}
+
+BACKENDS = {
+    "pdf": ("bookmark", "Document"),
+    "messages": ("messages", "Messages"),
+    "html": ("bkm", "BKM"),
+}
+
+
+def load(module):
+    if module not in sys.modules:
+        start = time.perf_counter()
+        importlib.import_module(module)
+        IMPORTS[module] = time.perf_counter() - start
+    return sys.modules[module]
+
+
+def report(limit=BUDGET, verbose=False):
+    startup = time.perf_counter() - START
+    if verbose:
+        for module, seconds in IMPORTS.items():
+            print(f"import {module:<24} {seconds * 1000:>8.1f} ms", file=sys.stderr)
+        print(f"startup {'':<24} {startup * 1000:>8.1f} ms (budget {limit * 1000:.0f} ms)", file=sys.stderr)
+    if startup > limit:
+        print(f"warning: startup took {startup:.2f}s, over the {limit:.2f}s budget", file=sys.stderr)
+
+
+def open_document(args):
+    """Build args.path with the chosen backend; returns the backend module and a function that rebuilds it."""
+    name, cls = BACKENDS[args.backend]
+    module = load(name)
+    report(args.budget, args.import_time)
+    if args.backend == "html":
+        doc = module.BKM()
+        def rebuild():
+            doc.build(args.path)
+            doc.write()
+        rebuild()
+        return module, rebuild
+    doc = getattr(module, cls)(args.path)
+    return module, doc.rebuild
+
+
+def build(args):
+    if args.preview:
+        load("preview").serve(args.port)
+    open_document(args)
+    if args.preview:
+        print("Serving the preview until interrupted", file=sys.stderr)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+def watch(args):
+    if args.preview:
+        load("preview").serve(args.port)
+    module, rebuild = open_document(args)
+    print(f"Watching {args.path}", file=sys.stderr)
+    module.loop(args.path, rebuild)
+
+def measure(args):
+    TextMetrics = load("text_metrics").TextMetrics
+    report(args.budget, args.import_time)
+    metrics = TextMetrics((args.font, args.size), args.measurer)
+    widths, space = metrics.measure_words(list(args.words))
+    for word in args.words:
+        print(f"{word}\t{widths[word]:.2f}")
+    print(f"(space)\t{space:.2f}")
+    print(f"(line height)\t{metrics.line_height():.2f}")
+    TextMetrics.save()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="bookmark", description="Typeset .bkm documents")
+    parser.add_argument("--trace", metavar="FILE", help="Write a Chrome trace of the build to FILE and print a phase summary")
+    parser.add_argument("--trace-memory", action="store_true", help="Add tracemalloc snapshots to the trace")
+    parser.add_argument("--import-time", action="store_true", help="Print how long each backend took to import")
+    parser.add_argument("--budget", type=float, default=BUDGET, help="Warn when startup takes longer than this many seconds")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name, func, help in (("build", build, "Build the document once"), ("watch", watch, "Build, then rebuild whenever the source changes")):
+        command = commands.add_parser(name, help=help)
+        command.add_argument("path", help="Source .bkm file")
+        command.add_argument("--backend", choices=list(BACKENDS), default="pdf",
+                             help="pdf: bookmark.Document, messages: messages.Messages, html: bkm.BKM")
+        command.add_argument("--preview", action="store_true", help="Serve the HTML output and push changed pages to open browsers")
+        command.add_argument("--port", type=int, default=1234, help="Preview server port")
+        command.set_defaults(func=func)
+
+    command = commands.add_parser("measure", help="Print word widths and the line height for a font")
+    command.add_argument("font", help="Font family, file name or path")
+    command.add_argument("words", nargs="+")
+    command.add_argument("--size", default=16, type=float, help="Size in pt")
+    command.add_argument("--measurer", choices=["playwright", "freetype"], default="freetype")
+    command.set_defaults(func=measure)
+
+    args = parser.parse_args(argv)
+    if args.trace or args.trace_memory:
+        load("instrument").enable(args.trace, args.trace_memory)
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,5 @@
 import bookmark
 
-bookmark.loop(bookmark.Document().path)
+if __name__ == "__main__":
+    doc = bookmark.Document()
+    bookmark.loop(doc.path, doc.rebuild)
@@ -0,0 +1,322 @@
+"""
+Backend-neutral display list: pages of positioned text runs and rectangles, written out as PDF and/or HTML.
+
+Layout draws into a DisplayList through the subset of the reportlab canvas API it uses;
+PDFWriter and HTMLWriter then consume the same pages, so both outputs share one layout pass.
+"""
+
+import html
+import math
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from reportlab.lib import colors
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+import fonts
+import preview
+from instrument import span
+
+BLACK = (0, 0, 0)
+
+
+class Page:
+    """One page: its size and the items drawn on it.
+
+    Items are ("text", x, y, text, font, size, fill), ("words", x, y, words, offsets, font, size, fill) for a
+    justified line whose words start at x + offsets, ("rect", x, y, width, height, fill, stroke), ("form", name)
+    placing a shared form and ("field", x, y, template, font, size, fill) for text formatted per page with
+    {page} and {pages}. Colours are RGB tuples (None when a rect isn't filled or stroked) and coordinates
+    are in points from the bottom left.
+    """
+    __slots__ = ("size", "items")
+
+    def __init__(self, size, items=None):
+        self.size = size
+        self.items = [] if items is None else items
+
+    def __eq__(self, other):
+        return isinstance(other, Page) and self.size == other.size and self.items == other.items
+
+
+class DisplayList:
+    """Records drawing calls made with reportlab canvas methods into pages of runs and rects.
+
+    Like a canvas, font and colours reset to Helvetica 12 and black on every new page. Between beginForm()
+    and endForm() drawing goes into a named form instead, which pages then place with doForm(); writers
+    emit each form once however many pages use it.
+    """
+    def __init__(self, pagesize):
+        self.pagesize = pagesize
+        self.pages = [Page(pagesize)]
+        self.forms: dict[str, Page] = {}
+        self.form = None
+        self.items = self.pages[-1].items
+        self.reset()
+
+    def reset(self):
+        self.font = ("Helvetica", 12)
+        self.fill = BLACK
+        self.stroke = BLACK
+
+    def stringWidth(self, text, font, size):
+        fonts.ensure(font)
+        return pdfmetrics.stringWidth(text, font, size)
+
+    def getPageNumber(self):
+        return len(self.pages)
+
+    def setPageSize(self, size):
+        self.pagesize = size
+        self.pages[-1].size = size
+
+    def setFont(self, name, size, leading=None):
+        fonts.ensure(name)
+        self.font = (str(name), size)
+
+    def setFillColor(self, color, alpha=None):
+        self.fill = colors.toColor(color).rgb()
+
+    def setStrokeColor(self, color, alpha=None):
+        self.stroke = colors.toColor(color).rgb()
+
+    def drawString(self, x, y, text):
+        self.items.append(("text", x, y, text, *self.font, self.fill))
+
+    def drawWords(self, words):
+        """Draw (x, y, word) tuples sharing one baseline as a single line."""
+        x, y, _ = words[0]
+        self.items.append(("words", x, y, tuple(word for _, _, word in words), tuple(wx - x for wx, _, _ in words), *self.font, self.fill))
+
+    def drawField(self, x, y, template):
+        self.items.append(("field", x, y, template, *self.font, self.fill))
+
+    def rect(self, x, y, width, height, stroke=1, fill=0):
+        self.items.append(("rect", x, y, width, height, self.fill if fill else None, self.stroke if stroke else None))
+
+    def beginForm(self, name):
+        self.form = name
+        self.forms[name] = Page(self.pagesize)
+        self.items = self.forms[name].items
+        self.outside = (self.font, self.fill, self.stroke)
+
+    def endForm(self):
+        self.form = None
+        self.items = self.pages[-1].items
+        self.font, self.fill, self.stroke = self.outside
+
+    def doForm(self, name):
+        self.items.append(("form", name))
+
+    def showPage(self):
+        self.pages.append(Page(self.pagesize))
+        if self.form is None:
+            self.items = self.pages[-1].items
+        self.reset()
+
+    def mark(self):
+        return (len(self.pages), len(self.pages[-1].items), self.pages[-1].size, self.pagesize, self.font, self.fill, self.stroke,
+                self.form, len(self.items), dict(self.forms), getattr(self, "outside", None))
+
+    def rewind(self, mark):
+        pages, items, size, self.pagesize, self.font, self.fill, self.stroke, self.form, form_items, forms, self.outside = mark
+        del self.pages[pages:]
+        del self.pages[-1].items[items:]
+        self.pages[-1].size = size
+        self.forms = dict(forms)
+        self.items = self.pages[-1].items if self.form is None else self.forms[self.form].items
+        del self.items[form_items:]
+
+
+def field(template, page, pages):
+    """`template` with {page} and {pages} filled in; any other braces are kept as they are."""
+    return template.replace("{page}", str(page)).replace("{pages}", str(pages))
+
+def textline(c, x, y, words, offsets, name, size):
+    """One text object for a justified line: the gaps go into word spacing when the font encodes the space as a
+    single byte (reportlab's standard fonts), into relative Td moves for TrueType subsets."""
+    text = c.beginText(x, y)
+    if not isinstance(pdfmetrics.getFont(name), TTFont) and not any(" " in word for word in words):
+        natural = c.stringWidth(" ".join(words[:-1]) + " ", name, size)
+        text.setWordSpace((offsets[-1] - natural) / (len(words) - 1))
+        text.textOut(" ".join(words))
+        text.setWordSpace(0)
+    else:
+        previous = 0
+        for word, offset in zip(words, offsets):
+            if offset != previous:
+                text.moveCursor(offset - previous, 0)
+                previous = offset
+            text.textOut(word)
+    c.drawText(text)
+
+def draw(c, items, forms, state, page=None, pages=None):
+    """Draw display items on `c`. `state` is the [font, fill, stroke] last set on it; fields are only drawn given a page number."""
+    for item in items:
+        kind = item[0]
+        if kind == "form":
+            c.doForm(item[1])
+            draw(c, [field for field in forms[item[1]].items if field[0] == "field"], forms, state, page, pages)
+        elif kind == "rect":
+            _, x, y, width, height, fill, stroke = item
+            if fill is not None and fill != state[1]:
+                state[1] = fill
+                c.setFillColorRGB(*fill)
+            if stroke is not None and stroke != state[2]:
+                state[2] = stroke
+                c.setStrokeColorRGB(*stroke)
+            c.rect(x, y, width, height, stroke=stroke is not None, fill=fill is not None)
+        elif kind != "field" or page is not None:
+            name, size, color = item[-3:]
+            if (name, size) != state[0]:
+                state[0] = (name, size)
+                fonts.ensure(name)
+                c.setFont(name, size)
+            if color != state[1]:
+                state[1] = color
+                c.setFillColorRGB(*color)
+            if kind == "text":
+                c.drawString(*item[1:4])
+            elif kind == "words":
+                textline(c, *item[1:7])
+            else:
+                c.drawString(item[1], item[2], field(item[3], page, pages))
+
+def render(filename, pages, forms=None, first=1, total=None):
+    """Render `pages`, numbered from `first` out of `total`, compiling every form once as a form XObject."""
+    forms = forms or {}
+    c = canvas.Canvas(filename, pages[0].size)
+    for name, form in forms.items():
+        c.beginForm(name, 0, 0, *form.size)
+        draw(c, form.items, forms, [None, None, None])
+        c.endForm()
+    for number, page in enumerate(pages, first):
+        c.setPageSize(page.size)
+        draw(c, page.items, forms, [None, None, None], number, total or len(pages))
+        c.showPage()
+    c.save()
+
+
+class PDFWriter:
+    """Renders a display list with reportlab, splitting the pages across `jobs` processes and merging with pypdf."""
+    def __init__(self, filename, jobs=1):
+        self.filename = filename
+        self.jobs = jobs
+
+    def write(self, display):
+        pages = display.pages
+        size = max(1, math.ceil(len(pages) / self.jobs))
+        starts = range(0, len(pages), size)
+        if len(starts) <= 1:
+            render(self.filename, pages, display.forms)
+            return
+
+        from pypdf import PdfWriter
+        with tempfile.TemporaryDirectory() as tmp, ProcessPoolExecutor(self.jobs, initializer=fonts.declare_all, initargs=(fonts.FONTS,)) as pool:
+            parts = [os.path.join(tmp, f"{i}.pdf") for i in range(len(starts))]
+            list(pool.map(render, parts, [pages[i:i+size] for i in starts], [display.forms] * len(starts),
+                          [i + 1 for i in starts], [len(pages)] * len(starts)))
+            writer = PdfWriter()
+            for part in parts:
+                writer.append(part)
+            writer.write(self.filename)
+
+
+STANDARD_STYLES = {"Bold": ("bold", "normal"), "Oblique": ("normal", "italic"), "Italic": ("normal", "italic"),
+                   "BoldOblique": ("bold", "italic"), "BoldItalic": ("bold", "italic")}
+
+def css_font(name):
+    """CSS family, weight and style for a reportlab font name such as "Helvetica-BoldOblique"."""
+    family, _, style = name.partition("-")
+    if style in STANDARD_STYLES:
+        return (family, *STANDARD_STYLES[style])
+    return name, "normal", "normal"
+
+def rgb(color):
+    return "#" + "".join(f"{round(c * 255):02x}" for c in color)
+
+
+class HTMLWriter:
+    """Writes a display list as one HTML file with an inline SVG per page.
+
+    Runs are stretched to their reportlab width with textLength, so lines break and justify exactly as in the PDF
+    even where the browser's copy of the font measures differently. Forms become <symbol>s defined once and <use>d per page.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write(self, display):
+        stylesheet = "".join(f'@font-face {{ font-family: "{name}"; src: url("file://{html.escape(os.path.abspath(path))}"); }}\n'
+                             for name, path in fonts.FONTS.items())
+        stylesheet += ("body { margin: 0; padding: 50px 0; background: #262626; display: grid; justify-content: center; row-gap: 50px; }\n"
+                       "svg.page { background: white; }\n")
+        # The form definitions go first among the body's elements, so the preview replaces them like any page when they change.
+        elements = []
+        if display.forms:
+            parts = ['<svg width="0" height="0" style="position: absolute">\n']
+            for name, form in display.forms.items():
+                width, height = form.size
+                parts.append(f'<symbol id="form-{html.escape(name)}" viewBox="0 0 {width} {height}">\n')
+                parts += self.items(form.items, height, display.forms)
+                parts.append("</symbol>\n")
+            parts.append("</svg>\n")
+            elements.append("".join(parts))
+        elements += [self.page(page, display.forms, number, len(display.pages)) for number, page in enumerate(display.pages, 1)]
+        hashes = [preview.digest(element) for element in elements]
+
+        with open(self.filename, "w", encoding="utf-8") as f:
+            f.write(f'<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="UTF-8">\n{preview.script()}'
+                    f'<style id="preview-style">\n{stylesheet}</style>\n{preview.state(hashes)}</head>\n<body>\n')
+            f.writelines(elements)
+            f.write("</body>\n</html>\n")
+        preview.publish(hashes, dict(zip(hashes, elements)).__getitem__, stylesheet)
+
+    def page(self, page, forms, number, pages):
+        width, height = page.size
+        parts = [f'<svg class="page" xmlns="http://www.w3.org/2000/svg" width="{width}pt" height="{height}pt" viewBox="0 0 {width} {height}">\n']
+        parts += self.items(page.items, height, forms, number, pages)
+        parts.append("</svg>\n")
+        return "".join(parts)
+
+    def items(self, items, height, forms, page=None, pages=None):
+        for item in items:
+            if item[0] == "text" or item[0] == "field" and page is not None:
+                _, x, y, text, name, size, color = item
+                if item[0] == "field":
+                    text = field(text, page, pages)
+                family, weight, style = css_font(name)
+                length = pdfmetrics.stringWidth(text, name, size)
+                yield (f'<text x="{x:.2f}" y="{height - y:.2f}" font-family="{html.escape(family)}" font-size="{size}" '
+                       f'font-weight="{weight}" font-style="{style}" fill="{rgb(color)}" xml:space="preserve" '
+                       f'textLength="{length:.2f}" lengthAdjust="spacingAndGlyphs">{html.escape(text)}</text>\n')
+            elif item[0] == "words":
+                _, x, y, words, offsets, name, size, color = item
+                family, weight, style = css_font(name)
+                yield (f'<text y="{height - y:.2f}" font-family="{html.escape(family)}" font-size="{size}" '
+                       f'font-weight="{weight}" font-style="{style}" fill="{rgb(color)}" xml:space="preserve">')
+                for word, offset in zip(words, offsets):
+                    length = pdfmetrics.stringWidth(word, name, size)
+                    yield f'<tspan x="{x + offset:.2f}" textLength="{length:.2f}" lengthAdjust="spacingAndGlyphs">{html.escape(word)}</tspan>'
+                yield "</text>\n"
+            elif item[0] == "rect":
+                _, x, y, w, h, fill, stroke = item
+                yield (f'<rect x="{x:.2f}" y="{height - y - h:.2f}" width="{w:.2f}" height="{h:.2f}" '
+                       f'fill="{rgb(fill) if fill else "none"}" stroke="{rgb(stroke) if stroke else "none"}"/>\n')
+            elif item[0] == "form":
+                form = forms[item[1]]
+                yield f'<use href="#form-{html.escape(item[1])}" width="{form.size[0]}" height="{form.size[1]}"/>\n'
+                yield from self.items([field for field in form.items if field[0] == "field"], height, forms, page, pages)
+
+
+def write(display, filename, outputs=("pdf",), jobs=1):
+    """Write `display` as each of `outputs` ("pdf", "html"), next to each other as `filename` with that extension."""
+    base = os.path.splitext(filename)[0]
+    with span("save"):
+        if "pdf" in outputs:
+            PDFWriter(base + ".pdf", jobs).write(display)
+    with span("serialize"):
+        if "html" in outputs:
+            HTMLWriter(base + ".html").write(display)
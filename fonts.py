@@ -0,0 +1,136 @@
+"""
+Process-wide registry of TrueType fonts for reportlab.
+
+Fonts are declared by name and path and only parsed and registered the first time something draws or measures with them.
+Each font file is parsed once per process, however often and under however many names it is declared.
+The code points each font file covers are cached under .bookmark/fonts by a hash of the file, so segmenting text
+by font doesn't parse fonts that end up unused.
+Text that mixes scripts or emoji is split into runs by which font in a fallback chain has glyphs for it.
+"""
+
+import copy
+import os
+import zlib
+
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+
+from instrument import span, count
+from text_metrics.cache_manager import fingerprint
+
+CACHE_DIR = os.path.join(".bookmark", "fonts")
+VERSION = 2
+
+# Declared fonts, name -> path
+FONTS: dict[str, str] = {}
+_pending = set()
+# Parsed fonts by (path, fingerprint), and the (path, fingerprint) each registered name was registered with
+_parsed: dict[tuple[str, str], TTFont] = {}
+_registered: dict[str, tuple[str, str]] = {}
+_coverage = {}
+_ascii = {}
+_segments = {}
+MAX_SEGMENTS = 100_000
+
+
+def declare(name, path):
+    path = os.path.expanduser(path)
+    FONTS[name] = path
+    # Declaring a registered name again, as every rebuild from the start does, leaves it registered.
+    if _registered.get(name) == (path, fingerprint(path)):
+        _pending.discard(name)
+    else:
+        _pending.add(name)
+
+def declare_all(fonts):
+    for name, path in fonts.items():
+        declare(name, path)
+
+def ensure(name):
+    """Register `name` with reportlab if it was declared and hasn't been registered yet."""
+    if name in _pending:
+        key = (FONTS[name], fingerprint(FONTS[name]))
+        with span("font-load"):
+            font = _parsed.get(key)
+            if font is None:
+                font = _parsed[key] = TTFont(name, FONTS[name])
+            elif font.fontName != name:
+                # Another name for a file already parsed: reportlab registers it as an alias of the same face.
+                font = copy.copy(font)
+                font.fontName = name
+            pdfmetrics.registerFont(font)
+        _registered[name] = key
+        _pending.discard(name)
+
+
+def coverage(name):
+    """Bitset of the code points `name` has glyphs for: the cmap of a declared TrueType font,
+    cp1252 for reportlab's standard fonts, nothing for a declared font whose file is missing."""
+    if name not in _coverage:
+        if name in FONTS and os.path.isfile(FONTS[name]):
+            _coverage[name] = cached_coverage(name)
+        else:
+            bits = bytearray(0x110000 >> 3)
+            codes = () if name in FONTS else [ord(c) for c in bytes(range(32, 256)).decode("cp1252", "ignore")]
+            for code in codes:
+                bits[code >> 3] |= 1 << (code & 7)
+            _coverage[name] = bytes(bits)
+    return _coverage[name]
+
+def cached_coverage(name):
+    """Coverage of a declared font file, read from the on-disk cache or computed from its cmap and stored there."""
+    cache = os.path.join(CACHE_DIR, f"{fingerprint(FONTS[name])}-{VERSION}.coverage")
+    try:
+        with open(cache, "rb") as f:
+            bits = zlib.decompress(f.read())
+        if len(bits) == 0x110000 >> 3:
+            count("font_cache.hit")
+            return bits
+    except (OSError, zlib.error):
+        pass
+    count("font_cache.miss")
+    ensure(name)
+    bits = bytearray(0x110000 >> 3)
+    for code in pdfmetrics.getFont(name).face.charToGlyph:
+        bits[code >> 3] |= 1 << (code & 7)
+    bits = bytes(bits)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f"{cache}.{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(zlib.compress(bits))
+    os.replace(tmp, cache)
+    return bits
+
+def covers_ascii(name):
+    if name not in _ascii:
+        bits = coverage(name)
+        _ascii[name] = all(bits[code >> 3] >> (code & 7) & 1 for code in range(32, 127))
+    return _ascii[name]
+
+def segment(text, chain):
+    """Split `text` into (font, run) pairs, giving each character to the first font in `chain` with a glyph for it
+    (the first font when none has one). Whitespace stays in the run it falls in."""
+    if len(chain) == 1 or text.isascii() and covers_ascii(chain[0]):
+        return ((chain[0], text),)
+    key = (text, chain)
+    runs = _segments.get(key)
+    if runs is None:
+        bitsets = [coverage(name) for name in chain]
+        runs = []
+        font = None
+        start = 0
+        for i, char in enumerate(text):
+            if font is not None and char.isspace():
+                continue
+            code = ord(char)
+            name = next((name for name, bits in zip(chain, bitsets) if bits[code >> 3] >> (code & 7) & 1), chain[0])
+            if name != font:
+                if font is not None:
+                    runs.append((font, text[start:i]))
+                font, start = name, i
+        if font is not None:
+            runs.append((font, text[start:]))
+        if len(_segments) >= MAX_SEGMENTS:
+            _segments.clear()
+        runs = _segments[key] = tuple(runs)
+    return runs
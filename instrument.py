@@ -0,0 +1,121 @@
+"""
+Build instrumentation: timed spans per command and phase, cache counters and optional memory snapshots.
+
+Disabled unless BOOKMARK_TRACE is set (to the path of the Chrome trace file) or enable() is called;
+while disabled, span() hands back one shared no-op context manager and count() returns immediately.
+"""
+
+import atexit
+import collections
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+enabled = False
+memory = False
+trace_path = None
+events = []
+counters = collections.Counter()
+snapshots = []
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL = NullSpan()
+
+
+class Span:
+    __slots__ = ("name", "category", "start")
+
+    def __init__(self, name, category):
+        self.name = name
+        self.category = category
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        events.append((self.name, self.category, self.start, time.perf_counter_ns() - self.start, threading.get_ident()))
+        if memory and self.category == "command":
+            snapshot(self.name)
+        return False
+
+
+def span(name, category="phase"):
+    return Span(name, category) if enabled else NULL
+
+def count(name, n=1):
+    if enabled:
+        counters[name] += n
+
+def warn(message):
+    """Report a problem with the source on stderr, whether or not instrumentation is on; counted as "warning"."""
+    count("warning")
+    print(f"warning: {message}", file=sys.stderr)
+
+def snapshot(label):
+    if enabled and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshots.append((label, time.perf_counter_ns(), current, peak))
+
+def enable(path=None, trace_memory=False):
+    global enabled, memory, trace_path
+    enabled = True
+    memory = trace_memory
+    trace_path = path
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def reset():
+    events.clear()
+    counters.clear()
+    snapshots.clear()
+
+
+def write_trace(path):
+    """Write everything recorded so far as Chrome trace-event JSON (chrome://tracing, Perfetto)."""
+    pid = os.getpid()
+    trace = [{"name": name, "cat": category, "ph": "X", "ts": start / 1000, "dur": duration / 1000, "pid": pid, "tid": tid}
+             for name, category, start, duration, tid in events]
+    trace += [{"name": "memory", "ph": "C", "ts": ts / 1000, "pid": pid, "args": {"current": current, "peak": peak}}
+              for _, ts, current, peak in snapshots]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": trace, "otherData": {"counters": dict(counters)}}, f)
+
+def summary():
+    totals = collections.defaultdict(lambda: [0, 0])
+    for name, category, _, duration, _ in events:
+        totals[(category, name)][0] += duration
+        totals[(category, name)][1] += 1
+
+    rows = [f"{'category':<10} {'name':<24} {'calls':>8} {'total ms':>11} {'mean ms':>9}"]
+    for (category, name), (duration, calls) in sorted(totals.items(), key=lambda item: -item[1][0]):
+        rows.append(f"{category:<10} {name:<24} {calls:>8} {duration / 1e6:>11.2f} {duration / 1e6 / calls:>9.3f}")
+    for name, value in sorted(counters.items()):
+        rows.append(f"{'counter':<10} {name:<24} {value:>8}")
+    if snapshots:
+        rows.append(f"{'memory':<10} {'peak MiB':<24} {max(peak for *_, peak in snapshots) / 2**20:>8.1f}")
+    return "\n".join(rows)
+
+def report():
+    if not enabled or not (events or counters):
+        return
+    if trace_path:
+        write_trace(trace_path)
+    print(summary(), file=sys.stderr)
+
+
+if os.environ.get("BOOKMARK_TRACE"):
+    enable(os.environ["BOOKMARK_TRACE"], bool(os.environ.get("BOOKMARK_TRACE_MEMORY")))
+atexit.register(report)
@@ -1,4 +1,7 @@
 import freetype
+import numpy as np
+
+from instrument import count
 
 DPI = 96
 
@@ -71,37 +74,88 @@ pagesizes = PageSizeDict({
     'A10': (73.70078740157481, 104.88188976377954)})
     
 
+class GlyphTable:
+    """Advances and kerning pairs of one font at one size, built once and shared by every TextLayout."""
+    _tables = {}
+
+    def __init__(self, font_path: str, font_size_pt: int):
+        self.face = freetype.Face(font_path)
+        self.face.set_char_size(font_size_pt * 64, 0, DPI, 0)
+        self.face.load_glyph(0, freetype.FT_LOAD_DEFAULT)
+        self.notdef = self.face.glyph.advance.x >> 6
+
+        chars = list(self.face.get_chars())
+        self.advances = np.full(max((code for code, _ in chars), default=0) + 1, self.notdef, dtype=np.int64)
+        for code, gindex in chars:
+            self.face.load_glyph(gindex, freetype.FT_LOAD_DEFAULT)
+            self.advances[code] = self.face.glyph.advance.x >> 6
+        self.kerning = {}
+
+    @classmethod
+    def get(cls, font_path: str, font_size_pt: int):
+        key = (font_path, font_size_pt)
+        if key not in cls._tables:
+            count("glyph_table.miss")
+            cls._tables[key] = cls(font_path, font_size_pt)
+        else:
+            count("glyph_table.hit")
+        return cls._tables[key]
+
+    def advance(self, codes: np.ndarray):
+        result = np.full(len(codes), self.notdef, dtype=np.int64)
+        known = codes < len(self.advances)
+        result[known] = self.advances[codes[known]]
+        return result
+
+    def kern(self, left: np.ndarray, right: np.ndarray):
+        if not self.face.has_kerning or not len(left):
+            return np.zeros(len(left), dtype=np.int64)
+        pairs, inverse = np.unique(left * 0x110000 + right, return_inverse=True)
+        values = np.empty(len(pairs), dtype=np.int64)
+        for i, pair in enumerate(pairs.tolist()):
+            if pair not in self.kerning:
+                self.kerning[pair] = self.face.get_kerning(chr(pair // 0x110000), chr(pair % 0x110000)).x >> 6
+            values[i] = self.kerning[pair]
+        return values[inverse]
+
+
 class TextLayout:
     def __init__(self, text: str, font_path: str, font_size_pt: int):
         self.text = text
         self.font_path = font_path
         self.font_size_pt = font_size_pt
-        self.face = freetype.Face(font_path)
-        self.face.set_char_size(font_size_pt * 64, 0, DPI, 0)
+        self.table = GlyphTable.get(font_path, font_size_pt)
+        self.face = self.table.face
+
+    def widths(self, words: list[str], letter_spacing: float = 0, kerning: bool = True, prev_char = None):
+        """Width of every word in one pass, kerning each word against the last character of the previous one."""
+        codes = np.frombuffer("".join(words).encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+        per_char = self.table.advance(codes)
+        if kerning and len(codes):
+            per_char[1:] += self.table.kern(codes[:-1], codes[1:])
+            if prev_char:
+                per_char[0] += self.table.kern(np.array([ord(prev_char)]), codes[:1])[0]
+        if letter_spacing:
+            per_char = per_char + letter_spacing
+
+        lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+        ends = np.cumsum(lengths)
+        totals = np.concatenate(([0], np.cumsum(per_char)))
+        return totals[ends] - totals[ends - lengths]
 
     def width(self, text:str = "", letter_spacing: float = 0, kerning: bool = True, prev_char = None):
         text = self.text if text == "" else text
-        width = 0
-        for char in text:
-            self.face.load_char(char)
-            if kerning and prev_char:
-                k = self.face.get_kerning(prev_char, char)
-                width += k.x >> 6
-            width += self.face.glyph.advance.x >> 6
-            width += letter_spacing
-            prev_char = char
-        return width, prev_char
+        width = self.widths([text], letter_spacing, kerning, prev_char)[0].item()
+        return width, (text[-1] if text else prev_char)
 
     def lines(self, max_width: float, letter_spacing: float = 0, kerning: bool = True):
         words = self.text.split(' ')
         lines = 0
         line_width = 0
-        prev_char = None
 
         space_width, _ = self.width(" ", letter_spacing, kerning)
 
-        for word in words:
-            word_width, last_char = self.width(word, letter_spacing, kerning, prev_char)
+        for word_width in self.widths(words, letter_spacing, kerning).tolist():
             additional_width = word_width + (space_width if line_width > 0 else 0)
 
             if line_width + additional_width <= max_width:
@@ -109,12 +163,32 @@ class TextLayout:
             else:
                 lines += 1
                 line_width = word_width
-            prev_char = last_char
 
         if line_width > 0:
             lines += 1
 
         return lines + len(self.text.splitlines()) - 1
 
+    def breaks(self, max_width: float, letter_spacing: float = 0, kerning: bool = True):
+        """Word count of every line when the text is broken greedily at `max_width`; an overlong word gets a line of its own."""
+        space_width, _ = self.width(" ", letter_spacing, kerning)
+        counts = []
+        count = 0
+        line_width = 0
+
+        for word_width in self.widths(self.text.split(), letter_spacing, kerning).tolist():
+            additional_width = word_width + (space_width if count else 0)
+            if not count or line_width + additional_width <= max_width:
+                line_width += additional_width
+                count += 1
+            else:
+                counts.append(count)
+                count = 1
+                line_width = word_width
+
+        if count:
+            counts.append(count)
+        return counts
+
     def height(self, max_width: float):
         return (self.font_size_pt * DPI / 72) * 1.2 * self.lines(max_width)
@@ -0,0 +1,198 @@
+import atexit
+import hashlib
+import math
+import os
+import sqlite3
+import struct
+import time
+
+from instrument import span, count
+
+STRETCH = 1/2
+SHRINK = 1/3
+TOLERANCE = 2
+LINE_PENALTY = 10
+FITNESS_DEMERITS = 10000
+
+CACHE_PATH = os.path.join(".bookmark", "layout.sqlite")
+# Part of every key; bump it when the meaning of cached values changes
+VERSION = 3
+MAX_ENTRIES = 100_000
+SCHEMA_VERSION = 1
+
+
+def greedy(widths: list[float], width: float, space: float):
+    """First-fit line breaking. Returns (start, end) word ranges, one per line."""
+    lines = []
+    start = 0
+    current = 0
+    for i, w in enumerate(widths):
+        test = current + (space if i > start else 0) + w
+        if test <= width or i == start:
+            current = test
+        else:
+            lines.append((start, i))
+            start, current = i, w
+    if start < len(widths):
+        lines.append((start, len(widths)))
+    return lines
+
+
+def justify(widths: list[float], lines: list[tuple[int, int]], width: float, space: float):
+    """Offset of every word from the start of its line once each line is stretched to `width`.
+
+    The last line and lines of a single word are ragged: their words are set with plain spaces.
+    """
+    offsets = []
+    for i, (start, end) in enumerate(lines):
+        extra = 0
+        if end - start > 1 and i < len(lines) - 1:
+            extra = (width - sum(widths[start:end]) - (end - start - 1) * space) / (end - start - 1)
+        cursor = 0
+        for j in range(start, end):
+            offsets.append(cursor)
+            cursor += widths[j] + space + extra
+    return offsets
+
+
+class Node:
+    __slots__ = ("position", "line", "fitness", "demerits", "previous")
+
+    def __init__(self, position, line, fitness, demerits, previous):
+        self.position = position
+        self.line = line
+        self.fitness = fitness
+        self.demerits = demerits
+        self.previous = previous
+
+
+def fitness(ratio):
+    if ratio < -0.5: return 0
+    if ratio <= 0.5: return 1
+    if ratio <= 1: return 2
+    return 3
+
+def optimal(widths: list[float], width: float, space: float, tolerance: float = TOLERANCE):
+    """Knuth-Plass total-fit line breaking over inter-word glue, with a ragged last line.
+
+    Active nodes are dropped as soon as the line from them overflows, so each word is only
+    compared against the few breaks that can still reach it. Single words always make a
+    feasible line, so overlong words get a line of their own instead of stalling the search.
+    """
+    n = len(widths)
+    if n == 0:
+        return []
+    totals = [0.0]
+    for w in widths:
+        totals.append(totals[-1] + w)
+
+    active = [Node(0, 0, 1, 0, None)]
+    for end in range(1, n + 1):
+        candidates = {}
+        survivors = []
+        for node in active:
+            count = end - node.position
+            gaps = count - 1
+            natural = totals[end] - totals[node.position] + gaps * space
+            if natural > width:
+                ratio = (width - natural) / (gaps * space * SHRINK) if gaps else -math.inf
+            elif end == n:
+                ratio = 0
+            else:
+                ratio = (width - natural) / (gaps * space * STRETCH) if gaps else math.inf
+
+            if ratio < -1 and count > 1:
+                continue
+            survivors.append(node)
+            if ratio <= tolerance or count == 1:
+                badness = 0 if end == n and ratio >= 0 else 100 * min(abs(ratio), 10) ** 3
+                cls = fitness(ratio)
+                demerits = node.demerits + (LINE_PENALTY + badness) ** 2
+                if abs(cls - node.fitness) > 1:
+                    demerits += FITNESS_DEMERITS
+                best = candidates.get(cls)
+                if best is None or demerits < best.demerits:
+                    candidates[cls] = Node(end, node.line + 1, cls, demerits, node)
+        active = survivors + list(candidates.values())
+
+    node = min((node for node in active if node.position == n), key=lambda node: node.demerits)
+    lines = []
+    while node.previous is not None:
+        lines.append((node.previous.position, node.position))
+        node = node.previous
+    lines.reverse()
+    return lines
+
+
+def pack(ends: list[int], values: list[float]) -> bytes:
+    return struct.pack(f"<II{len(ends)}I{len(values)}d", len(ends), len(values), *ends, *values)
+
+def unpack(data: bytes):
+    n, m = struct.unpack_from("<II", data)
+    ends = struct.unpack_from(f"<{n}I", data, 8)
+    values = struct.unpack_from(f"<{m}d", data, 8 + 4 * n)
+    return ends, values
+
+
+class BreakCache:
+    """Line-break results keyed by a hash of the text and all typesetting parameters, kept in SQLite.
+
+    Lookups read the database directly; new entries and the keys of hits are buffered and written by save()
+    in one transaction, which also drops the least recently used entries beyond MAX_ENTRIES.
+    """
+    _db = None
+    pending: dict[str, bytes] = {}
+    used: set[str] = set()
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def connect(cls):
+        if cls._db is None:
+            os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+            cls._db = sqlite3.connect(CACHE_PATH, timeout=30, check_same_thread=False)
+            cls._db.execute("PRAGMA journal_mode=WAL")
+            with cls._db as db:
+                if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                    db.execute("DROP TABLE IF EXISTS breaks")
+                    db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                db.execute("CREATE TABLE IF NOT EXISTS breaks (key TEXT PRIMARY KEY, value BLOB NOT NULL, used REAL NOT NULL)")
+        return cls._db
+
+    @staticmethod
+    def key(*params) -> str:
+        return hashlib.blake2b(repr((VERSION,) + params).encode("utf-8"), digest_size=16).hexdigest()
+
+    @classmethod
+    def get(cls, key: str):
+        value = cls.pending.get(key)
+        if value is None:
+            row = cls.connect().execute("SELECT value FROM breaks WHERE key = ?", (key,)).fetchone()
+            value = row[0] if row else None
+        if value is None:
+            cls.misses += 1
+            count("break_cache.miss")
+            return None
+        cls.hits += 1
+        cls.used.add(key)
+        count("break_cache.hit")
+        return unpack(value)
+
+    @classmethod
+    def put(cls, key: str, ends: list[int], values: list[float]):
+        cls.pending[key] = pack(ends, values)
+
+    @classmethod
+    def save(cls):
+        if not cls.pending and not cls.used:
+            return
+        now = time.time()
+        with span("save"), cls.connect() as db:
+            db.executemany("INSERT OR REPLACE INTO breaks VALUES (?, ?, ?)", [(key, value, now) for key, value in cls.pending.items()])
+            db.executemany("UPDATE breaks SET used = ? WHERE key = ?", [(now, key) for key in cls.used - cls.pending.keys()])
+            db.execute("DELETE FROM breaks WHERE rowid IN (SELECT rowid FROM breaks ORDER BY used DESC LIMIT -1 OFFSET ?)", (MAX_ENTRIES,))
+        cls.pending = {}
+        cls.used = set()
+
+
+atexit.register(BreakCache.save)
@@ -1,85 +1,128 @@
 import enum
 import bookmark
 from reportlab.lib import colors
+import hashlib
 import json
+import os
 import re
+from array import array
 
+CACHE_DIR = os.path.join(".bookmark", "messages")
+VERSION = 1
+CHUNK_SIZE = 1 << 16
+# Export parts are numbered message_1.json, message_2.json, ..., newest first
+PART = re.compile(r"message_(\d+)\.json")
+# Bubble and text colours, indexed by whether the sender gets the dark bubble
+COLORS = ((colors.pink, colors.black), (colors.black, colors.white))
 
-class Messages(bookmark.Document):
-    def __init__(self):
-        super().__init__()
-
-    # def drawEmojiString(self, x, y, text):
-    #     cursor_x = x
-    #     parts = emoji_pattern.split(text)
-    #     emojis = emoji_pattern.findall(text)
-    #     font = self.font
-    #
-    #     for i, part in enumerate(parts):
-    #         # Draw normal text
-    #         if part:
-    #             self.setfont(font)
-    #             self.canvas.drawString(cursor_x, y, part)
-    #             cursor_x += self.canvas.stringWidth(part, font, font.size)
-    #
-    #         # Draw emoji (if any after this part)
-    #         if i < len(emojis):
-    #             emoji = emojis[i]
-    #             self.setfont("Emoji")
-    #             self.canvas.drawString(cursor_x, y, emoji)
-    #             cursor_x += self.canvas.stringWidth(emoji, "Emoji", 12)
-    #     self.setfont(font)
-
-    def get_messages(self):
-        msg_data = []
-        for i in range(3):
-            with open(f"./message_{i+1}.json", "r") as f:
-                data = json.load(f)["messages"]
-                msg_data += data
-        msg_data.reverse()
-
-        messages = []
-        for msg in msg_data:
+
+def records(f, key="messages"):
+    """Decode the objects of the top-level `key` array one at a time, reading `f` in chunks."""
+    decoder = json.JSONDecoder()
+    start = re.compile(rf'"{key}"\s*:\s*\[')
+    buffer = ""
+    match = None
+    while match is None:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        buffer += chunk
+        match = start.search(buffer)
+    pos = match.end()
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            record, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # A record cut off by the end of the buffer: drop what's been decoded and read on.
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                raise
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield record
+
+
+def normalized(path):
+    """Path of a JSON-lines copy of one export part: [sender, content] per message, oldest first, text repaired.
+
+    Rebuilt only when the part's mtime or size changes. The cache name includes a hash of the part's
+    resolved directory, so parts of different exports that share a file name don't overwrite each other.
+    """
+    stat = os.stat(path)
+    header = json.dumps([VERSION, stat.st_mtime_ns, stat.st_size]) + "\n"
+    directory = hashlib.blake2b(os.path.dirname(os.path.realpath(path)).encode("utf-8"), digest_size=8).hexdigest()
+    cache = os.path.join(CACHE_DIR, f"{directory}-{os.path.splitext(os.path.basename(path))[0]}.jsonl")
+    try:
+        with open(cache, "r", encoding="utf-8") as f:
+            if f.readline() == header:
+                return cache
+    except OSError:
+        pass
+
+    messages = []
+    with open(path, "r") as f:
+        for msg in records(f):
             if "content" in msg:
-                # messages.append(msg["sender_name"].split(" ")[0].upper()+": "+msg["content"].encode("latin-1").decode("utf-8"))
-                # messages.append(msg["content"].encode("latin-1").decode("utf-8"))
-                messages.append({"sender": msg["sender_name"].split(" ")[0].lower(), "content": msg["content"].encode("latin-1").decode("utf-8")})
-        return messages
+                messages.append(json.dumps([msg["sender_name"].split(" ")[0].lower(), msg["content"].encode("latin-1").decode("utf-8")], ensure_ascii=False))
+    messages.reverse()
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f"{cache}.{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(header)
+        for line in messages:
+            f.write(line + "\n")
+    os.replace(tmp, cache)
+    return cache
+
+
+class Messages(bookmark.Document):
+    def __init__(self, path=None):
+        super().__init__(path)
+
+    def get_messages(self, directory="."):
+        """Yield {"sender", "content"} for every message in the export parts in `directory`, oldest first."""
+        parts = [(int(match.group(1)), name) for name in os.listdir(directory) if (match := PART.fullmatch(name))]
+        for _, name in sorted(parts, reverse=True):
+            path = os.path.join(directory, name)
+            with open(normalized(path), "r", encoding="utf-8") as f:
+                next(f)
+                for line in f:
+                    sender, content = json.loads(line)
+                    yield {"sender": sender, "content": content}
 
     def split(self):
-        messages = self.get_messages()[0::]
-        text = " ".join([msg["content"] for msg in messages]).replace("\n", " ")
+        # owner[i] is the message that word i of `text` came from, dark[m] whether message m gets the dark bubble
+        contents = []
+        owner = array("I")
+        dark = array("B")
+        for m, msg in enumerate(self.get_messages()):
+            contents.append(msg["content"])
+            owner.extend([m] * len(msg["content"].split()))
+            dark.append(msg["sender"] == "dylan")
+        text = " ".join(contents).replace("\n", " ")
+        del contents
         leading = int(self.font.size * 1.2)
-        pages = self.justifytext(text, leading=leading)
+        hpad = leading - self.font.size
 
-        m1 = 0
-        m2 = 0
-        for page in pages:
+        for page in self.justify(text, leading=leading, indices=True):
             for line in page:
-                for data in line:
-                    x, y, word = data
-                    x -= 1.4
-                    if word not in messages[m1]["content"]:
-                        m1 += 1
-                    sender = messages[m1]["sender"]
-                    w = self.canvas.stringWidth(word, self.font, self.font.size)+20
-                    h = leading
-                    hpad = (h-self.font.size)
-                    y -= hpad*2
-                    color = (colors.black, colors.white) if sender == "dylan" else (colors.pink, colors.black)
+                for x, y, word, index in line:
+                    color = COLORS[dark[owner[index]]]
+                    w = self.textwidth(word)+20
                     self.canvas.setFillColor(color[0])
-                    self.canvas.rect(x, y, w, h, fill=1, stroke=0)
+                    self.canvas.rect(x - 1.4, y - hpad*2, w, leading, fill=1, stroke=0)
             for line in page:
-                for data in line:
-                    x, y, word = data
-                    if word not in messages[m2]["content"]:
-                        m2 += 1
-                    sender = messages[m2]["sender"]
-                    color = (colors.black, colors.white) if sender == "dylan" else (colors.pink, colors.black)
-                    self.canvas.setFillColor(color[1])
-                    self.canvas.drawString(*data)
+                for x, y, word, index in line:
+                    self.canvas.setFillColor(COLORS[dark[owner[index]]][1])
+                    self.drawtext(x, y, word)
             self.newpage()
-
         
 
         # messages = self.get_messages()
@@ -138,4 +181,6 @@ class Messages(bookmark.Document):
         # self.paragraph(text)
 
 
-bookmark.loop(path=Messages().path)
+if __name__ == "__main__":
+    doc = Messages()
+    bookmark.loop(doc.path, doc.rebuild)
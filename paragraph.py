@@ -2,15 +2,27 @@
 """
 Word-Position Based Line Detection using Playwright
 Uses word-level position detection for accurate line breaks
+
+With --verify, checks the line breaks of every paragraph in a built BKM document against the browser's, in one
+browser session with several tabs working through the paragraphs concurrently, and writes a mismatch report.
 """
 
 import asyncio
-from playwright.async_api import async_playwright
 import argparse
+import functools
+import hashlib
 import json
+import os
+import re
+import sqlite3
+import time
 from pathlib import Path
 from typing import List, Dict
 
+CACHE_PATH = os.path.join(".bookmark", "verify.sqlite")
+# Paragraphs handed to a tab per evaluate() call
+BATCH = 100
+
 JS_LINE_EXTRACTOR = """
 (element) => {
     const clone = element.cloneNode(true);
@@ -89,8 +101,46 @@ JS_LINE_EXTRACTOR = """
 }
 """
 
+# Inlines the pages of chunked output, so every paragraph is in the document before extraction.
+JS_LOAD_CHUNKS = """
+async () => {
+    await Promise.all(Array.from(document.querySelectorAll('.chunk'), async chunk => {
+        const template = document.createElement('template');
+        template.innerHTML = await (await fetch(chunk.dataset.src)).text();
+        chunk.replaceWith(template.content.firstElementChild);
+    }));
+}
+"""
+
+JS_PARAGRAPHS = """
+() => Array.from(document.querySelectorAll('p.paragraph'), p => ({
+    id: p.id,
+    text: p.textContent,
+    width: p.style.width,
+    family: p.style.fontFamily.replace(/^["']|["']$/g, ''),
+    size: p.style.fontSize,
+}))
+"""
+
+# BKM sets each line it broke as a .line block; they are made inline again so the browser breaks the text itself.
+JS_BATCH_EXTRACTOR = f"""
+(ids) => {{
+    const extract = {JS_LINE_EXTRACTOR};
+    return ids.map(id => {{
+        const element = document.getElementById(id);
+        element.querySelectorAll('.line').forEach(line => {{
+            line.style.display = 'inline';
+            line.style.whiteSpace = 'normal';
+        }});
+        return extract(element);
+    }});
+}}
+"""
+
+
 async def get_rendered_paragraph_lines(html_file: str, headless: bool = True) -> Dict[str, List[str]]:
     """Extract actual rendered lines by analyzing word positions in browser layout"""
+    from playwright.async_api import async_playwright
     async with async_playwright() as p:
         browser = await p.chromium.launch(headless=headless)
         page = await browser.new_page()
@@ -120,6 +170,7 @@ async def get_rendered_paragraph_lines(html_file: str, headless: bool = True) ->
 
 async def get_specific_paragraph_lines(html_file: str, selector: str, headless: bool = True) -> List[str]:
     """Extract rendered lines from a specific paragraph using word-position detection"""
+    from playwright.async_api import async_playwright
     async with async_playwright() as p:
         browser = await p.chromium.launch(headless=headless)
         page = await browser.new_page()
@@ -145,6 +196,160 @@ async def get_specific_paragraph_lines(html_file: str, selector: str, headless:
             await browser.close()
 
 
+class LineCache:
+    """Word counts of the browser's lines per paragraph hash, kept in SQLite across runs."""
+    def __init__(self, path=CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("CREATE TABLE IF NOT EXISTS lines (key TEXT PRIMARY KEY, counts TEXT NOT NULL)")
+
+    def get(self, keys: List[str]) -> Dict[str, List[int]]:
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            rows = self.db.execute(f"SELECT key, counts FROM lines WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            found.update((key, json.loads(counts)) for key, counts in rows)
+        return found
+
+    def put(self, results: Dict[str, List[int]]):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO lines VALUES (?, ?)", [(key, json.dumps(counts)) for key, counts in results.items()])
+
+
+def paragraph_key(paragraph: dict, browser_version: str) -> str:
+    """Hash of everything the browser's line breaks depend on."""
+    params = (browser_version, paragraph["text"], paragraph["width"], paragraph["family"], paragraph["size"])
+    return hashlib.blake2b(repr(params).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def css_length(value: str, unit: str = "px") -> float:
+    from layout import convert
+    number, source = re.fullmatch(r"\s*([\d.]+)\s*([a-z]*)\s*", value).groups()
+    return float(number) * convert[source or "px"][unit]
+
+
+@functools.cache
+def bkm_document(measurer: str):
+    import bkm
+    doc = bkm.BKM()
+    doc.measurer = measurer
+    return doc
+
+
+def expected_counts(paragraph: dict, against: str, measurer: str):
+    """Words per line for `paragraph` as BKM.paragraph or TextLayout breaks it."""
+    size = css_length(paragraph["size"], "pt")
+    size = int(size) if size.is_integer() else size
+    max_width = css_length(paragraph["width"])
+    if against == "textlayout":
+        from layout import TextLayout
+        from text_metrics.freetype_measurer import resolve_font
+        path = resolve_font(paragraph["family"])
+        if path is None:
+            raise FileNotFoundError(f"No font file found for {paragraph['family']!r}")
+        return TextLayout(paragraph["text"], path, size).breaks(max_width)
+    ends, _, _ = bkm_document(measurer).breaklines(paragraph["text"].split(), (paragraph["family"], size), max_width)
+    return [end - start for start, end in zip([0] + ends[:-1], ends)]
+
+
+async def extract_all(html_file: str, tabs: int = 4, headless: bool = True, cache: LineCache | None = None):
+    """Browser line breaks of every paragraph in `html_file`: one browser, `tabs` pages pulling batches from a shared queue.
+
+    Returns the paragraphs, their cache keys, the word counts of their lines and how many came from the cache."""
+    import preview
+    server = preview.serve(0, str(Path(html_file).resolve().parent))
+    url = f"http://localhost:{server.server_address[1]}/{Path(html_file).name}"
+
+    from playwright.async_api import async_playwright
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=headless)
+        try:
+            async def open_page():
+                page = await browser.new_page()
+                await page.goto(url)
+                await page.evaluate(JS_LOAD_CHUNKS)
+                return page
+
+            pages = await asyncio.gather(*[open_page() for _ in range(max(1, tabs))])
+            paragraphs = await pages[0].evaluate(JS_PARAGRAPHS)
+            keys = [paragraph_key(paragraph, browser.version) for paragraph in paragraphs]
+            results = cache.get(keys) if cache else {}
+            cached = sum(key in results for key in keys)
+
+            todo = {}
+            for paragraph, key in zip(paragraphs, keys):
+                if key not in results:
+                    todo.setdefault(key, paragraph["id"])
+            queue = asyncio.Queue()
+            batch = list(todo.items())
+            for i in range(0, len(batch), BATCH):
+                queue.put_nowait(batch[i:i+BATCH])
+
+            async def work(page):
+                while not queue.empty():
+                    items = queue.get_nowait()
+                    lines = await page.evaluate(JS_BATCH_EXTRACTOR, [id for _, id in items])
+                    for (key, _), paragraph_lines in zip(items, lines):
+                        results[key] = [len(line.split()) for line in paragraph_lines if line.strip()]
+
+            await asyncio.gather(*[work(page) for page in pages])
+        finally:
+            await browser.close()
+
+    if cache:
+        cache.put({key: results[key] for key in todo})
+    return paragraphs, keys, results, cached
+
+
+def compare(paragraph: dict, key: str, browser: List[int], expected) -> dict | None:
+    """A report entry when the browser and the expected breaks disagree, else None."""
+    if list(expected) == browser:
+        return None
+    words = paragraph["text"].split()
+    def lines(counts):
+        ends = [0]
+        for count in counts:
+            ends.append(ends[-1] + count)
+        return [" ".join(words[start:end]) for start, end in zip(ends, ends[1:])]
+    browser_text, expected_text = lines(browser), lines(expected)
+    line = next((i for i, (a, b) in enumerate(zip(browser_text, expected_text)) if a != b), min(len(browser_text), len(expected_text)))
+    return {"id": paragraph["id"], "hash": key, "browser_lines": len(browser), "expected_lines": len(expected),
+            "first_difference": {"line": line + 1,
+                                 "browser": browser_text[line] if line < len(browser_text) else None,
+                                 "expected": expected_text[line] if line < len(expected_text) else None}}
+
+
+def verify(html_file: str, against: str = "bkm", measurer: str = "freetype", tabs: int = 4,
+           report: str = "verify-report.json", headless: bool = True) -> dict:
+    """Compare the browser's line breaks with BKM's (or TextLayout's) for every paragraph of `html_file`.
+
+    The browser's event loop is finished before the expected breaks are computed: the Playwright measurer runs
+    a loop of its own, which can't start inside a running one.
+    """
+    start = time.perf_counter()
+    paragraphs, keys, results, cached = asyncio.run(extract_all(html_file, tabs, headless, LineCache()))
+    browser_seconds = time.perf_counter() - start
+
+    mismatches = []
+    errors = []
+    for paragraph, key in zip(paragraphs, keys):
+        try:
+            expected = expected_counts(paragraph, against, measurer)
+        except FileNotFoundError as e:
+            errors.append({"id": paragraph["id"], "hash": key, "error": str(e)})
+            continue
+        entry = compare(paragraph, key, results[key], expected)
+        if entry:
+            mismatches.append(entry)
+
+    summary = {"document": str(html_file), "against": against, "measurer": measurer if against == "bkm" else "freetype",
+               "paragraphs": len(paragraphs), "cached": cached, "mismatches": len(mismatches), "errors": len(errors),
+               "browser_seconds": round(browser_seconds, 3), "total_seconds": round(time.perf_counter() - start, 3)}
+    with open(report, "w", encoding="utf-8") as f:
+        json.dump({"summary": summary, "mismatches": mismatches, "errors": errors}, f, indent=2, ensure_ascii=False)
+    return summary
+
+
 def print_results(results: Dict[str, List[str]]):
     """Pretty print the extracted lines"""
     if not results:
@@ -160,12 +365,16 @@ def print_results(results: Dict[str, List[str]]):
             print(f"{i:2d}: {line}")
 
 
-async def main():
+def main():
     parser = argparse.ArgumentParser(description="Extract lines using word-position detection")
     parser.add_argument("html_file", help="Path to HTML file")
     parser.add_argument("--selector", "-s", help="CSS selector for specific paragraph")
     parser.add_argument("--output", "-o", help="Output JSON file path")
     parser.add_argument("--visible", "-v", action="store_true", help="Run browser in visible mode")
+    parser.add_argument("--verify", choices=["bkm", "textlayout"], help="Compare every paragraph's browser line breaks with BKM's or TextLayout's")
+    parser.add_argument("--measurer", choices=["playwright", "freetype"], default="freetype", help="Measurer for --verify bkm")
+    parser.add_argument("--tabs", type=int, default=4, help="Browser tabs extracting paragraphs concurrently in --verify")
+    parser.add_argument("--report", default="verify-report.json", help="Mismatch report written by --verify")
 
     args = parser.parse_args()
 
@@ -175,8 +384,14 @@ async def main():
 
     headless = not args.visible
 
+    if args.verify:
+        summary = verify(args.html_file, args.verify, args.measurer, args.tabs, args.report, headless)
+        print(f"{summary['paragraphs']} paragraphs ({summary['cached']} cached), {summary['mismatches']} mismatches, "
+              f"{summary['errors']} errors in {summary['total_seconds']:.1f}s; report in {args.report}")
+        return
+
     if args.selector:
-        lines = await get_specific_paragraph_lines(args.html_file, args.selector, headless)
+        lines = asyncio.run(get_specific_paragraph_lines(args.html_file, args.selector, headless))
         results = {"selected_paragraph": lines}
 
         if not args.output:
@@ -184,7 +399,7 @@ async def main():
             for i, line in enumerate(lines, 1):
                 print(f"{i:2d}: {line}")
     else:
-        results = await get_rendered_paragraph_lines(args.html_file, headless)
+        results = asyncio.run(get_rendered_paragraph_lines(args.html_file, headless))
 
         if not args.output:
             print_results(results)
@@ -198,11 +413,12 @@ async def main():
 if __name__ == "__main__":
     import sys
     if len(sys.argv) > 1:
-        asyncio.run(main())
+        main()
     else:
         print("Usage examples:")
         print("python script.py file.html")
         print("python script.py file.html --selector 'p.article-content'")
         print("python script.py file.html --output results.json")
         print("python script.py file.html --visible")
+        print("python script.py index.html --verify bkm --tabs 8")
         print("\nUses word-level position detection for accurate line breaks")
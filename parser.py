@@ -1,22 +1,23 @@
+import hashlib
+import os
+import json
 import re
 
-# --- Patterns ---
-BLOCK_PATTERN = re.compile(
-    r";(\w+)\((.*?)\)"       # function name and args
-    r"(?:\s*:\s*(.*?))?"    # optional content after colon
-    r"(?=(?:\n\s*;|$))",    # stop at next ;func or end of text
-    re.DOTALL
-)
+from instrument import span, count, warn
 
-VAR_ASSIGN_PATTERN = re.compile(
-    r";(\w+)\s*=\s*(.*?)(?=(?:\n\s*;|$))",
-    re.DOTALL
-)
+CACHE_DIR = os.path.join(".bookmark", "programs")
+VERSION = 3
+# Programs cached for sources compiled without a path; the least recently written go first
+MAX_PROGRAMS = 64
 
-variables = {}
+# --- Patterns ---
+NAME = re.compile(r";(\w+)")
+ASSIGN = re.compile(r"\s*=\s*")
+CLOSE = re.compile(r"\s*(?::|$)")
 
-def parse_value(val: str):
+def parse_value(val: str, variables: dict | None = None):
     val = val.strip().rstrip(",")
+    variables = {} if variables is None else variables
 
     # function reference (escaped semicolon)
     if val.startswith(r"\;"):
@@ -51,7 +52,7 @@ def parse_value(val: str):
                 current.append(c)
         if current:
             parts.append("".join(current).strip())
-        return tuple(parse_value(p) for p in parts)
+        return tuple(parse_value(p, variables) for p in parts)
 
     # integers / floats
     try:
@@ -62,7 +63,7 @@ def parse_value(val: str):
         except ValueError:
             return val  # fallback: keep as string
 
-def parse_args(args_str: str):
+def parse_args(args_str: str, variables: dict | None = None):
     args = {}
     if not args_str:
         return args
@@ -84,41 +85,156 @@ def parse_args(args_str: str):
     for part in parts:
         if "=" in part:
             k, v = part.split("=", 1)
-            args[k.strip()] = parse_value(v)
+            args[k.strip()] = parse_value(v, variables)
         else:
-            args["arg"] = parse_value(part)
+            args["arg"] = parse_value(part, variables)
     return args
 
-# First pass: collect variable assignments
-def parse_vars(text: str):
-    for m in VAR_ASSIGN_PATTERN.finditer(text):
-        var_name, val = m.groups()
-        variables[var_name] = parse_value(val)
+def statements(text: str):
+    """Split the source into statements, each starting at a line whose first non-blank character is ';'.
+
+    Only "\n" ends a line, as in the regex parser this replaced; splitlines() would also split on form feeds
+    and Unicode line separators inside paragraph text.
+    """
+    current = []
+    for line in text.split("\n"):
+        line = line.removesuffix("\r")
+        if line.lstrip().startswith(";"):
+            if current:
+                yield "\n".join(current).strip()
+            current = [line.lstrip()]
+        elif current:
+            current.append(line)
+    if current:
+        yield "\n".join(current).strip()
+
+def tokenize(text: str):
+    """Yield ("var", name, value) and ("block", func, args, content) tokens in a single pass over the source."""
+    for statement in statements(text):
+        name = NAME.match(statement)
+        if not name:
+            continue
+        end = name.end()
+
+        assign = ASSIGN.match(statement, end)
+        if assign:
+            yield ("var", name.group(1), statement[assign.end():])
+            continue
+
+        if not statement.startswith("(", end):
+            continue
+        # The arguments end at the first ")" followed by a colon or the end of the statement.
+        close = statement.find(")", end)
+        while close != -1:
+            after = CLOSE.match(statement, close + 1)
+            if after:
+                content = statement[after.end():] if after.group().endswith(":") else ""
+                yield ("block", name.group(1), statement[end + 1:close], content.strip())
+                break
+            close = statement.find(")", close + 1)
+
+def compile_program(code: str):
+    """Resolve variables and arguments into a list of {"func", "args", "content"} blocks."""
+    variables = {}
+    tokens = list(tokenize(code))
+    for token in tokens:
+        if token[0] == "var":
+            variables[token[1]] = parse_value(token[2], variables)
 
-# Second pass: parse function blocks
-def parse_blocks(text: str):
     result = []
-    for func, args_str, content in BLOCK_PATTERN.findall(text):
-        func = func.strip()
-        # resolve variable function reference
-        if func in variables:
-            func = variables[func]
-        args = parse_args(args_str) if args_str else {}
-        result.append({
-            "func": func,
-            "args": args,
-            "content": content.strip() if content else ""
-        })
+    for token in tokens:
+        if token[0] == "block":
+            _, func, args_str, content = token
+            # resolve variable function reference
+            if func in variables:
+                func = variables[func]
+            result.append({
+                "func": func,
+                "args": parse_args(args_str, variables) if args_str else {},
+                "content": content
+            })
     return result
 
-def interpret(cls:object, code:str):
-    parse_vars(code)
-    print(parse_blocks)
-    for parsed in parse_blocks(code):
-        if hasattr(cls, parsed["func"]):
-            if parsed["content"]:
-                parsed["args"]["content"] = parsed["content"]
-            getattr(cls, parsed["func"])(**parsed["args"])
-        else:
-            print(f"Ignoring unknown function: {parsed['func']}")
+def encode(value):
+    if isinstance(value, tuple):
+        return {"__tuple__": [encode(v) for v in value]}
+    return value
+
+def decode(value):
+    if isinstance(value, dict):
+        if list(value) != ["__tuple__"] or not isinstance(value["__tuple__"], list):
+            raise ValueError("not an encoded tuple")
+        return tuple(decode(v) for v in value["__tuple__"])
+    if value is not None and not isinstance(value, (str, int, float)):
+        raise ValueError(f"unexpected value {value!r}")
+    return value
 
+def load(path, key):
+    """The blocks cached at `path` for `key`, or None if the file is missing, stale, or not a program cache."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if not isinstance(cached, dict) or cached.get("version") != VERSION or cached.get("key") != key:
+            return None
+        blocks = []
+        for block in cached["blocks"]:
+            if not (isinstance(block["func"], str) and isinstance(block["args"], dict) and isinstance(block["content"], str)):
+                return None
+            blocks.append({"func": block["func"], "args": {k: decode(v) for k, v in block["args"].items()}, "content": block["content"]})
+        return blocks
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def prune():
+    entries = [entry for entry in os.scandir(CACHE_DIR) if entry.name.startswith("program-")]
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[MAX_PROGRAMS:]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+def program(code: str, path: str | None = None):
+    """compile_program(), cached on disk by a hash of the source.
+
+    The cache keeps one entry per source `path`, replaced whenever the source changes; sources
+    without a path get an entry of their own, of which only the newest MAX_PROGRAMS are kept.
+    """
+    key = hashlib.sha256(f"{VERSION}\0{code}".encode("utf-8")).hexdigest()
+    if path is None:
+        name = f"program-{key}.json"
+    else:
+        name = f"source-{hashlib.sha256(os.path.abspath(path).encode('utf-8')).hexdigest()[:32]}.json"
+    cache = os.path.join(CACHE_DIR, name)
+    blocks = load(cache, key)
+    if blocks is not None:
+        count("program_cache.hit")
+        return blocks
+    count("program_cache.miss")
+
+    with span("parse"):
+        blocks = compile_program(code)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f"{cache}.{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": VERSION, "key": key, "blocks": [
+            {"func": block["func"], "args": {k: encode(v) for k, v in block["args"].items()}, "content": block["content"]}
+            for block in blocks]}, f)
+    os.replace(tmp, cache)
+    if path is None:
+        prune()
+    return blocks
+
+def execute(cls: object, parsed: dict):
+    if hasattr(cls, parsed["func"]):
+        args = dict(parsed["args"])
+        if parsed["content"]:
+            args["content"] = parsed["content"]
+        with span(parsed["func"], "command"):
+            getattr(cls, parsed["func"])(**args)
+    else:
+        warn(f"ignoring unknown function: {parsed['func']}")
+
+def interpret(cls:object, code:str):
+    for parsed in program(code):
+        execute(cls, parsed)
@@ -0,0 +1,224 @@
+"""
+Preview server: serves the rendered view and pushes changed pages to open browsers over a websocket.
+
+Pages are identified by a hash of their HTML. After a rebuild, publish() sends each connected browser the new
+order of hashes and the HTML of only the pages it doesn't have yet, which it asks the document for; the browser
+keeps every other page element, so an edit on one page re-parses one page and the scroll position is left alone.
+Standard library only.
+"""
+
+import base64
+import functools
+import hashlib
+import http.server
+import json
+import os
+import struct
+import sys
+import threading
+
+from instrument import span, count
+
+PORT = 1234
+GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+CLIENT = """(() => {
+  const state = JSON.parse(document.getElementById("preview-state").textContent);
+  const view = document.querySelector("body");
+  let hashes = state.hashes;
+
+  function update(message) {
+    if (message.style !== undefined) document.getElementById("preview-style").textContent = message.style;
+    // Looked up on every update: a lazily loaded page replaces its placeholder element in place.
+    const elements = new Map(hashes.map((hash, i) => [hash, view.children[i]]));
+    const next = new Map();
+    const order = message.hashes.map(hash => {
+      let element = elements.get(hash);
+      if (element === undefined || next.has(hash)) {
+        const template = document.createElement("template");
+        template.innerHTML = element === undefined ? message.pages[hash] : element.outerHTML;
+        element = template.content.firstElementChild;
+      }
+      next.set(hash, element);
+      return element;
+    });
+    order.forEach((element, i) => {
+      if (view.children[i] !== element) view.insertBefore(element, view.children[i] || null);
+    });
+    while (view.children.length > order.length) view.lastElementChild.remove();
+    hashes = message.hashes;
+  }
+
+  function connect() {
+    const socket = new WebSocket("ws://localhost:%(port)d/events");
+    socket.onopen = () => socket.send(JSON.stringify({hashes}));
+    socket.onmessage = event => update(JSON.parse(event.data));
+    socket.onclose = () => setTimeout(connect, 1000);
+  }
+  connect();
+})();
+"""
+
+# The first server started, which documents link their preview client to, and every server by the directory it serves
+server = None
+servers: dict[str, http.server.ThreadingHTTPServer] = {}
+hashes: list[str] = []
+# Returns the HTML of the current page with a given hash
+source = None
+style = ""
+clients = set()
+lock = threading.Lock()
+
+
+def hasher():
+    """An empty hash that, fed a page's HTML piece by piece, ends with the same hexdigest() as digest()."""
+    return hashlib.blake2b(digest_size=8)
+
+def digest(html):
+    return hashlib.blake2b(html.encode("utf-8"), digest_size=8).hexdigest()
+
+def script():
+    """The tag that loads the preview client, or nothing when no preview server is running."""
+    if server is None:
+        return ""
+    return f'<script src="http://localhost:{PORT}/preview.js" defer></script>\n'
+
+def state(page_hashes):
+    """The script a written document embeds so the browser knows which page has which hash."""
+    return f'<script id="preview-state" type="application/json">{json.dumps({"hashes": page_hashes})}</script>\n'
+
+
+class Client:
+    """One websocket connection and the page hashes its browser currently holds."""
+    def __init__(self, sock, known):
+        self.sock = sock
+        self.known = set(known)
+        self.style = None
+        self.lock = threading.Lock()
+
+    def push(self, page_hashes, page, stylesheet):
+        """Send the page order and the pages this browser is missing, looking their HTML up with `page`."""
+        with self.lock:
+            message = {"hashes": page_hashes, "pages": {h: page(h) for h in dict.fromkeys(page_hashes) if h not in self.known}}
+            if stylesheet != self.style:
+                message["style"] = self.style = stylesheet
+            count("preview.pages_sent", len(message["pages"]))
+            self.sock.sendall(frame(json.dumps(message).encode("utf-8")))
+            self.known = set(page_hashes)
+
+    def send(self, payload, opcode=0x1):
+        with self.lock:
+            self.sock.sendall(frame(payload, opcode))
+
+
+def frame(payload, opcode=0x1):
+    header = bytes([0x80 | opcode])
+    if len(payload) < 126:
+        header += bytes([len(payload)])
+    elif len(payload) < 1 << 16:
+        header += bytes([126]) + struct.pack("!H", len(payload))
+    else:
+        header += bytes([127]) + struct.pack("!Q", len(payload))
+    return header + payload
+
+
+def receive(rfile):
+    """Read one client frame; returns (opcode, payload), or (0x8, b"") once the connection is gone."""
+    head = rfile.read(2)
+    if len(head) < 2:
+        return 0x8, b""
+    opcode, length = head[0] & 0x0F, head[1] & 0x7F
+    if length == 126:
+        length, = struct.unpack("!H", rfile.read(2))
+    elif length == 127:
+        length, = struct.unpack("!Q", rfile.read(8))
+    mask = rfile.read(4) if head[1] & 0x80 else b"\0\0\0\0"
+    data = rfile.read(length)
+    return opcode, bytes(b ^ mask[i & 3] for i, b in enumerate(data))
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/preview.js":
+            body = (CLIENT % {"port": self.server.server_address[1]}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/javascript")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/events" and self.headers.get("Upgrade", "").lower() == "websocket":
+            self.websocket()
+        else:
+            super().do_GET()
+
+    def websocket(self):
+        accept = base64.b64encode(hashlib.sha1(self.headers["Sec-WebSocket-Key"].encode() + GUID).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.close_connection = True
+
+        client = None
+        try:
+            while True:
+                opcode, payload = receive(self.rfile)
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    (client or Client(self.connection, ())).send(payload, 0xA)
+                elif opcode == 0x1 and client is None:
+                    # The browser says which pages it has, then gets whatever it's missing.
+                    client = Client(self.connection, json.loads(payload).get("hashes", ()))
+                    with lock:
+                        clients.add(client)
+                        current = (hashes, source, style)
+                    if current[1] is not None:
+                        client.push(*current)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with lock:
+                clients.discard(client)
+
+
+def serve(port=PORT, directory="."):
+    """Return a server for `directory`, starting one on a background thread unless one already serves it
+    (port 0 picks a free one). Every server pushes the same pages over its websocket."""
+    global server, PORT
+    root = os.path.abspath(directory)
+    if root not in servers:
+        instance = http.server.ThreadingHTTPServer(("localhost", port), functools.partial(Handler, directory=root))
+        instance.daemon_threads = True
+        threading.Thread(target=instance.serve_forever, daemon=True).start()
+        servers[root] = instance
+        if server is None:
+            server = instance
+            PORT = instance.server_address[1]
+        print(f"Preview of {root} at http://localhost:{instance.server_address[1]}/", file=sys.stderr)
+    return servers[root]
+
+def publish(page_hashes, page, stylesheet=""):
+    """Make `page_hashes` the current pages and push each connected browser the ones it is missing.
+
+    `page` returns the HTML of the page with a given hash, so only pages some browser lacks are serialized again.
+    The lock only guards the shared state; sending happens outside it, so a slow browser doesn't hold up the others.
+    """
+    global hashes, source, style
+    with span("publish"):
+        with lock:
+            hashes = list(page_hashes)
+            source = page
+            style = stylesheet
+            current = (hashes, source, style)
+            receivers = list(clients)
+        for client in receivers:
+            try:
+                client.push(*current)
+            except OSError:
+                with lock:
+                    clients.discard(client)
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Run every test in its own directory, so the .bookmark caches start empty, with in-process caches reset."""
+    monkeypatch.chdir(tmp_path)
+    if "linebreak" in sys.modules:
+        from linebreak import BreakCache
+        monkeypatch.setattr(BreakCache, "_db", None)
+        monkeypatch.setattr(BreakCache, "pending", {})
+        monkeypatch.setattr(BreakCache, "used", set())
+    if "text_metrics.cache_manager" in sys.modules:
+        from text_metrics.cache_manager import WordCacheManager
+        monkeypatch.setattr(WordCacheManager, "_shards", {})
+        monkeypatch.setattr(WordCacheManager, "_metrics", None)
+        monkeypatch.setattr(WordCacheManager, "_new_metrics", {})
+    if "text_metrics.metrics" in sys.modules:
+        from text_metrics.metrics import LINE_HEIGHTS
+        LINE_HEIGHTS.clear()
+    return tmp_path
+
+
+@pytest.fixture
+def font_path():
+    """A TrueType font file on this machine for the FreeType-based code."""
+    pytest.importorskip("freetype")
+    from text_metrics.freetype_measurer import resolve_font
+    path = resolve_font("DejaVuSans") or resolve_font("Arial") or resolve_font("Helvetica")
+    if path is None or not path.lower().endswith(".ttf"):
+        pytest.skip("no TrueType font found")
+    return path
@@ -0,0 +1,101 @@
+import os
+import re
+
+import pytest
+
+from bkm import BKM, CHUNK_DIR
+
+PARAGRAPH = "Words of a paragraph that runs over several lines of the page, repeated to fill it. " * 6
+
+
+def source(edit="", chunked=True, output="html"):
+    paragraphs = "".join(f';paragraph(font=("DejaVuSans", 12), linebreak={"optimal" if i % 2 else "greedy"}):\n'
+                         f"{i}{edit if i == 7 else ''} {PARAGRAPH}\n" for i in range(10))
+    return (f";document(size=A6, measurer=freetype, chunked={chunked}, output={output})\n"
+            f";settings(guides=False)\n;page()\n{paragraphs}")
+
+
+def build(bkm, code):
+    with open("doc.bkm", "w") as f:
+        f.write(code)
+    bkm.build("doc.bkm")
+    bkm.write()
+
+
+def output():
+    """The written HTML and page files, with what depends on the process rather than the document normalized."""
+    names = ["index.html"] + [os.path.join(CHUNK_DIR, name) for name in sorted(os.listdir(CHUNK_DIR))] if os.path.isdir(CHUNK_DIR) else ["index.html"]
+    texts = []
+    for name in names:
+        with open(name, encoding="utf-8") as f:
+            text = f.read()
+        text = re.sub(r'id="e\d+"', 'id=""', text)
+        text = re.sub(r'"hashes": \[[^\]]*\]', '"hashes": []', text)
+        texts.append(re.sub(r"\?[0-9a-f]{16}", "", text))
+    return names, texts
+
+
+@pytest.mark.parametrize("edit", [" edited", " and now a much longer edit that adds a line or two to the paragraph " * 3])
+def test_incremental_rebuild_on_flushed_pages_matches_full_build(edit, font_path, tmp_path_factory, monkeypatch):
+    bkm = BKM()
+    build(bkm, source())
+    # The edited paragraph is on a page that has been written out and dropped from memory.
+    edited = 10
+    assert bkm.blocks[edited]["content"].startswith("7")
+    pages = bkm.checkpoints[edited][1]
+    assert pages < len(bkm.pages) and bkm.pages[pages - 1] is None
+    build(bkm, source(edit))
+    rebuilt = output()
+
+    monkeypatch.chdir(tmp_path_factory.mktemp("fresh"))
+    build(BKM(), source(edit))
+    assert output() == rebuilt
+
+
+def test_chunked_output_matches_single_file(font_path):
+    build(BKM(), source(chunked=False))
+    with open("index.html", encoding="utf-8") as f:
+        single = f.read()
+    build(BKM(), source(chunked=True))
+    for name in sorted(os.listdir(CHUNK_DIR)):
+        with open(os.path.join(CHUNK_DIR, name), encoding="utf-8") as f:
+            page = re.sub(r'id="e\d+"', "", f.read())
+        assert page in re.sub(r'id="e\d+"', "", single)
+
+
+def test_pdf_has_a_line_for_every_html_line(font_path):
+    pypdf = pytest.importorskip("pypdf")
+    bkm = BKM()
+    build(bkm, source(chunked=False, output="both"))
+    with open("index.html", encoding="utf-8") as f:
+        html_lines = f.read().count('<span class="line')
+    pdf_lines = sum(len(page.items) for page in bkm.canvas.pages)
+    assert html_lines == pdf_lines
+    assert len(pypdf.PdfReader("index.pdf").pages) == len(bkm.pages)
+
+
+def test_published_pages_dont_change_with_the_next_build(font_path, monkeypatch):
+    import preview
+    monkeypatch.setattr(preview, "server", object())
+    for name in ("hashes", "source", "style"):
+        monkeypatch.setattr(preview, name, getattr(preview, name))
+    bkm = BKM()
+    build(bkm, source(chunked=False))
+    hashes, page = preview.hashes, preview.source
+    before = [page(digest) for digest in hashes]
+    assert [preview.digest(text) for text in before] == hashes
+
+    build(bkm, source(" edited", chunked=False).replace(";paragraph", ";page()\n;paragraph", 1))
+    assert preview.hashes != hashes
+    assert [page(digest) for digest in hashes] == before
+
+
+def test_rebuild_drops_the_spread_grid():
+    bkm = BKM()
+    build(bkm, ";document(spread=true)\n;page()\n")
+    assert "grid-template-columns" in bkm.view.style
+    build(bkm, ";document(spread=false)\n;page()\n")
+    fresh = BKM()
+    fresh.build("doc.bkm")
+    assert bkm.view.style == fresh.view.style
+    assert "grid-template-columns" not in bkm.view.style
@@ -0,0 +1,91 @@
+import pytest
+
+from bookmark import BookmarkError, Document
+
+SOURCE = f""";document(size=A6, output=both)
+;setmargin(all=20)
+;paragraph():
+The first paragraph is long enough to be broken over a few lines of this small page.
+
+;heading(text=Heading, level=2)
+;paragraph(linebreak=optimal):
+A second paragraph, broken with the optimal line breaker, {"which fills the page up and carries on over the next. " * 40}
+
+;paragraph():
+The third paragraph, which the edits below change, ends the document.
+"""
+
+MASTER = """;document(size=A6, output=both)
+;master()
+;rectangle(x=10, y=10, width=278, height=400)
+;pagenumber(x=20, y=20, format="Page {page} of {pages} {x}")
+;endmaster()
+;usemaster()
+;paragraph():
+Text on the first page.
+;newpage()
+;paragraph():
+Text on the second page.
+"""
+
+
+def document(source, name="doc.bkm"):
+    with open(name, "w") as f:
+        f.write(source)
+    return Document(name)
+
+
+def pages(doc):
+    return [page.items for page in doc.canvas.pages]
+
+
+@pytest.mark.parametrize("edit", [
+    lambda source: source.replace("third paragraph", "third and final paragraph"),
+    lambda source: source.replace("A second paragraph", "An edited second paragraph"),
+    lambda source: source + ";paragraph():\nAn appended paragraph.\n",
+    lambda source: source.replace(";heading(text=Heading, level=2)\n", ""),
+])
+def test_rebuild_matches_full_build(edit):
+    doc = document(SOURCE)
+    assert len(doc.canvas.pages) > 1
+    with open("doc.bkm", "w") as f:
+        f.write(edit(SOURCE))
+    doc.rebuild()
+    assert pages(doc) == pages(document(edit(SOURCE), "fresh.bkm"))
+    assert doc.cursor_y == document(edit(SOURCE), "fresh.bkm").cursor_y
+
+
+def test_rebuild_without_changes_keeps_the_layout():
+    doc = document(SOURCE)
+    before = pages(doc)
+    checkpoints = doc.checkpoints[:]
+    doc.rebuild()
+    assert pages(doc) == before
+    assert doc.checkpoints == checkpoints
+
+
+def test_master_page_fields():
+    doc = document(MASTER)
+    assert pages(doc)[0][0] == ("form", "default")
+    assert pages(doc)[1][0] == ("form", "default")
+    with open("output.html", encoding="utf-8") as f:
+        text = f.read()
+    assert "Page 1 of 2 {x}" in text and "Page 2 of 2 {x}" in text
+
+
+def test_text_in_a_master_page_doesnt_move_the_cursor():
+    with_master = document(MASTER)
+    without = document(MASTER.replace(";pagenumber", ";heading(text=Number, level=1)\n;pagenumber"), "other.bkm")
+    assert [item[1:3] for item in pages(with_master)[0][1:]] == [item[1:3] for item in pages(without)[0][1:]]
+
+
+def test_master_page_isnt_drawn_over_content():
+    doc = document(MASTER.replace(";usemaster()\n;paragraph():\nText on the first page.\n",
+                                  ";paragraph():\nText on the first page.\n;usemaster()\n"))
+    assert ("form", "default") not in pages(doc)[0]
+    assert pages(doc)[1][0] == ("form", "default")
+
+
+def test_master_page_has_to_fit_on_one_page():
+    with pytest.raises(BookmarkError):
+        document(MASTER.replace(";endmaster()", ";newpage()\n;endmaster()"))
@@ -0,0 +1,88 @@
+import pytest
+
+import display
+from display import DisplayList, Page, field
+
+SIZE = (200, 300)
+
+
+def sample():
+    canvas = DisplayList(SIZE)
+    canvas.beginForm("frame")
+    canvas.setFont("Helvetica", 8)
+    canvas.rect(10, 10, 180, 280)
+    canvas.drawField(20, 20, "Page {page} of {pages}")
+    canvas.endForm()
+    canvas.doForm("frame")
+    canvas.setFont("Helvetica", 10)
+    canvas.drawString(20, 250, "Hello <world>")
+    canvas.showPage()
+    canvas.doForm("frame")
+    canvas.drawWords([(20, 250, "justified"), (90, 250, "words")])
+    return canvas
+
+
+def test_display_list_records_items_per_page():
+    canvas = sample()
+    black = display.BLACK
+    assert canvas.getPageNumber() == 2
+    assert canvas.forms["frame"].items == [("rect", 10, 10, 180, 280, None, black),
+                                           ("field", 20, 20, "Page {page} of {pages}", "Helvetica", 8, black)]
+    assert canvas.pages[0].items == [("form", "frame"), ("text", 20, 250, "Hello <world>", "Helvetica", 10, black)]
+    # A new page starts over with Helvetica 12, as on a reportlab canvas.
+    assert canvas.pages[1].items == [("form", "frame"), ("words", 20, 250, ("justified", "words"), (0, 70), "Helvetica", 12, black)]
+
+
+def test_rewind_to_mark():
+    canvas = DisplayList(SIZE)
+    canvas.drawString(0, 0, "kept")
+    mark = canvas.mark()
+    canvas.setFont("Courier", 9)
+    canvas.drawString(0, 10, "dropped")
+    canvas.showPage()
+    canvas.beginForm("later")
+    canvas.rewind(mark)
+    assert canvas.pages == [Page(SIZE, [("text", 0, 0, "kept", "Helvetica", 12, display.BLACK)])]
+    assert canvas.forms == {} and canvas.form is None and canvas.font == ("Helvetica", 12)
+    canvas.drawString(0, 20, "after")
+    assert len(canvas.pages[0].items) == 2
+
+
+def test_field_fills_in_page_numbers_only():
+    assert field("Page {page} of {pages}", 2, 5) == "Page 2 of 5"
+    assert field("{page} {x} {}", 1, 1) == "1 {x} {}"
+
+
+def test_write_html():
+    display.write(sample(), "out.pdf", ("html",))
+    with open("out.html", encoding="utf-8") as f:
+        text = f.read()
+    assert text.count('<symbol id="form-frame"') == 1
+    assert text.count('<use href="#form-frame"') == 2
+    assert "Page 1 of 2" in text and "Page 2 of 2" in text and "{page}" not in text
+    assert "Hello &lt;world&gt;" in text
+    assert ">justified</tspan>" in text and ">words</tspan>" in text
+    assert text.count('<svg class="page"') == 2
+
+
+def test_write_pdf():
+    pypdf = pytest.importorskip("pypdf")
+    display.write(sample(), "out.pdf", ("pdf",))
+    reader = pypdf.PdfReader("out.pdf")
+    assert len(reader.pages) == 2
+    first, second = (" ".join(page.extract_text().split()) for page in reader.pages)
+    assert "Hello <world>" in first and "Page 1 of 2" in first
+    assert "justified" in second and "words" in second and "Page 2 of 2" in second
+
+
+def test_write_pdf_with_jobs_matches_one_job():
+    pypdf = pytest.importorskip("pypdf")
+    canvas = sample()
+    for _ in range(4):
+        canvas.showPage()
+        canvas.doForm("frame")
+    display.write(canvas, "one.pdf", ("pdf",))
+    display.write(canvas, "two.pdf", ("pdf",), jobs=2)
+    texts = [[page.extract_text() for page in pypdf.PdfReader(name).pages] for name in ("one.pdf", "two.pdf")]
+    assert texts[0] == texts[1]
+    assert "Page 6 of 6" in texts[1][-1]
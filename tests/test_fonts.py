@@ -0,0 +1,49 @@
+import shutil
+
+from reportlab.pdfbase import pdfmetrics, ttfonts
+
+import fonts
+
+
+def count_parses(monkeypatch):
+    parses = []
+    init = ttfonts.TTFontFace.__init__
+    def counting(self, filename, *args, **kwargs):
+        parses.append(filename)
+        init(self, filename, *args, **kwargs)
+    monkeypatch.setattr(ttfonts.TTFontFace, "__init__", counting)
+    return parses
+
+
+def test_font_file_is_parsed_once(font_path, tmp_path, monkeypatch):
+    parses = count_parses(monkeypatch)
+    path = str(tmp_path / "once.ttf")
+    shutil.copyfile(font_path, path)
+    for _ in range(3):
+        fonts.declare("Once", path)
+        fonts.ensure("Once")
+    fonts.declare("OnceAgain", path)
+    fonts.ensure("OnceAgain")
+    assert parses == [path]
+    assert pdfmetrics.stringWidth("words", "OnceAgain", 12) == pdfmetrics.stringWidth("words", "Once", 12) > 0
+
+
+def test_coverage_is_cached_by_fingerprint(font_path, tmp_path, monkeypatch):
+    path = str(tmp_path / "covered.ttf")
+    shutil.copyfile(font_path, path)
+    fonts.declare("Covered", path)
+    bits = fonts.coverage("Covered")
+    assert bits[ord("a") >> 3] >> (ord("a") & 7) & 1
+
+    # Another process only reads the cache file, so segmenting doesn't parse the font.
+    parses = count_parses(monkeypatch)
+    monkeypatch.setattr(fonts, "_coverage", {})
+    fonts.declare("Covered again", path)
+    assert fonts.coverage("Covered again") == bits
+    assert parses == []
+
+
+def test_segment_gives_characters_to_the_first_font_with_a_glyph(font_path):
+    fonts.declare("Segmented", font_path)
+    assert fonts.segment("plain text", ("Helvetica", "Segmented")) == (("Helvetica", "plain text"),)
+    assert fonts.segment("a → b", ("Helvetica", "Segmented")) == (("Helvetica", "a "), ("Segmented", "→ "), ("Helvetica", "b"))
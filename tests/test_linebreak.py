@@ -0,0 +1,89 @@
+import sqlite3
+
+import linebreak
+from linebreak import BreakCache, greedy, justify, optimal, pack, unpack
+
+
+def test_greedy_fills_each_line_first():
+    assert greedy([3, 3, 3, 3], 7, 1) == [(0, 2), (2, 4)]
+    assert greedy([], 7, 1) == []
+
+
+def test_greedy_gives_overlong_words_a_line():
+    assert greedy([2, 10, 2], 5, 1) == [(0, 1), (1, 2), (2, 3)]
+
+
+def test_optimal_shrinks_a_line_rather_than_leave_one_loose():
+    widths = [2, 1, 3, 2, 2, 2]
+    assert greedy(widths, 10, 1) == [(0, 3), (3, 6)]
+    assert optimal(widths, 10, 1) == [(0, 4), (4, 6)]
+
+
+def test_optimal_matches_greedy_when_lines_fit_exactly():
+    widths = [4, 5, 4, 5, 3]
+    assert optimal(widths, 10, 1) == greedy(widths, 10, 1) == [(0, 2), (2, 4), (4, 5)]
+    assert optimal([], 10, 1) == []
+
+
+def test_optimal_gives_overlong_words_a_line():
+    assert optimal([2, 12, 2], 10, 1) == [(0, 1), (1, 2), (2, 3)]
+
+
+def test_justify_stretches_all_but_ragged_lines():
+    offsets = justify([2, 3, 4, 1, 1], [(0, 2), (2, 3), (3, 5)], 10, 1)
+    # The gap of the first line takes up the slack; a single word and the last line keep plain spaces.
+    assert offsets == [0, 7, 0, 0, 2]
+
+
+def test_pack_round_trip():
+    ends, values = unpack(pack([2, 5], [0.5, 1.25, 3.0]))
+    assert ends == (2, 5)
+    assert values == (0.5, 1.25, 3.0)
+
+
+def test_break_cache_round_trip():
+    key = BreakCache.key("text", ("Helvetica", 12), 400, "greedy")
+    assert BreakCache.get(key) is None
+    BreakCache.put(key, [3, 7], [0.0, 12.5])
+    assert BreakCache.get(key) == ((3, 7), (0.0, 12.5))
+    BreakCache.save()
+
+    BreakCache._db = None
+    assert BreakCache.get(key) == ((3, 7), (0.0, 12.5))
+
+
+def test_break_cache_key_covers_every_parameter():
+    key = BreakCache.key("text", ("Helvetica", 12), 400, "greedy")
+    assert key == BreakCache.key("text", ("Helvetica", 12), 400, "greedy")
+    assert key != BreakCache.key("text", ("Helvetica", 12), 400, "optimal")
+    assert key != BreakCache.key("text", ("Helvetica", 12), 401, "greedy")
+    assert key != BreakCache.key("text", ("Helvetica", 13), 400, "greedy")
+
+
+def test_break_cache_drops_least_recently_used(monkeypatch):
+    monkeypatch.setattr(linebreak, "MAX_ENTRIES", 2)
+    times = iter(range(100))
+    monkeypatch.setattr(linebreak.time, "time", lambda: next(times))
+    for name in ("a", "b"):
+        BreakCache.put(name, [1], [])
+        BreakCache.save()
+    assert BreakCache.get("a") is not None
+    BreakCache.put("c", [1], [])
+    BreakCache.save()
+
+    keys = {key for key, in BreakCache.connect().execute("SELECT key FROM breaks")}
+    assert keys == {"a", "c"}
+
+
+def test_break_cache_recreates_old_schema(tmp_path):
+    linebreak.os.makedirs(".bookmark")
+    db = sqlite3.connect(linebreak.CACHE_PATH)
+    db.execute("CREATE TABLE breaks (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+    db.execute("INSERT INTO breaks VALUES ('old', x'00')")
+    db.commit()
+    db.close()
+
+    assert BreakCache.get("old") is None
+    BreakCache.put("new", [1], [2.0])
+    BreakCache.save()
+    assert BreakCache.get("new") == ((1,), (2.0,))
@@ -0,0 +1,61 @@
+import io
+import json
+import os
+
+import messages
+from messages import Messages, normalized, records
+
+
+def export(path, texts, sender="Dylan Example"):
+    """An export part as Facebook writes it: newest message first, UTF-8 text escaped as Latin-1."""
+    entries = [{"sender_name": sender, "timestamp_ms": i, "content": text.encode("utf-8").decode("latin-1")}
+               for i, text in enumerate(reversed(texts))]
+    entries.insert(1, {"sender_name": sender, "timestamp_ms": 0, "photos": [{"uri": "photo.jpg"}]})
+    with open(path, "w") as f:
+        json.dump({"participants": [{"name": sender}], "messages": entries, "title": "Chat"}, f, indent=2)
+
+
+def test_records_decode_in_order_across_chunks(monkeypatch):
+    monkeypatch.setattr(messages, "CHUNK_SIZE", 7)
+    entries = [{"content": f"message {i} with \"quotes\", [brackets] and {{braces}}"} for i in range(50)]
+    text = json.dumps({"participants": [{"messages": "not this one"}], "messages": entries, "title": "x"}, indent=1)
+    assert list(records(io.StringIO(text))) == entries
+    assert list(records(io.StringIO('{"messages": []}'))) == []
+    assert list(records(io.StringIO('{"title": "no messages"}'))) == []
+
+
+def test_normalized_part_is_oldest_first_and_repaired():
+    export("message_1.json", ["first", "café ☕", "last"])
+    with open(normalized("message_1.json"), encoding="utf-8") as f:
+        next(f)
+        assert [json.loads(line) for line in f] == [["dylan", "first"], ["dylan", "café ☕"], ["dylan", "last"]]
+
+
+def test_normalized_part_is_rebuilt_when_it_changes():
+    export("message_1.json", ["old"])
+    cache = normalized("message_1.json")
+    export("message_1.json", ["new", "and longer"])
+    assert normalized("message_1.json") == cache
+    with open(cache, encoding="utf-8") as f:
+        assert f.read().count("\n") == 3
+
+
+def test_parts_of_different_exports_have_their_own_cache():
+    os.makedirs("one")
+    os.makedirs("two")
+    export(os.path.join("one", "message_1.json"), ["from one"])
+    export(os.path.join("two", "message_1.json"), ["from two"])
+    assert normalized(os.path.join("one", "message_1.json")) != normalized(os.path.join("two", "message_1.json"))
+
+
+def test_get_messages_reads_parts_oldest_first():
+    for number in (1, 2, 10):
+        export(f"message_{number}.json", [f"part {number} first", f"part {number} last"], sender="Alex Example")
+    for stray in ("message_3.json.bak", "message_x.json", "old_message_4.json"):
+        with open(stray, "w") as f:
+            f.write("not an export part")
+
+    doc = Messages.__new__(Messages)
+    contents = [message["content"] for message in doc.get_messages()]
+    assert contents == ["part 10 first", "part 10 last", "part 2 first", "part 2 last", "part 1 first", "part 1 last"]
+    assert {message["sender"] for message in doc.get_messages()} == {"alex"}
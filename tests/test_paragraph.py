@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+import paragraph
+from paragraph import LineCache, compare, expected_counts, paragraph_key
+
+TEXT = "The quick brown fox jumps over the lazy dog and keeps on running through the field " * 4
+
+
+def test_line_cache_round_trip(tmp_path):
+    path = str(tmp_path / "cache" / "lines.sqlite")
+    LineCache(path).put({"a": [3, 4, 1], "b": [2]})
+    cache = LineCache(path)
+    assert cache.get(["a", "b", "c"]) == {"a": [3, 4, 1], "b": [2]}
+    cache.put({"a": [5]})
+    assert LineCache(path).get(["a"]) == {"a": [5]}
+
+
+def test_line_cache_reads_many_keys():
+    cache = LineCache("cache/lines.sqlite")
+    cache.put({str(i): [i] for i in range(1200)})
+    assert len(cache.get([str(i) for i in range(1500)])) == 1200
+
+
+def test_paragraph_key_covers_everything_breaks_depend_on():
+    paragraph = {"text": "Some text", "width": "300px", "family": "Arial", "size": "12pt"}
+    key = paragraph_key(paragraph, "120.0")
+    assert key == paragraph_key(dict(paragraph), "120.0")
+    assert key != paragraph_key(paragraph, "121.0")
+    for name, value in (("text", "Other text"), ("width", "301px"), ("family", "Times"), ("size", "13pt")):
+        assert key != paragraph_key({**paragraph, name: value}, "120.0")
+
+
+def test_compare_reports_the_first_differing_line():
+    entry = {"id": "e1", "text": "one two three four five"}
+    assert compare(entry, "k", [2, 3], [2, 3]) is None
+    assert compare(entry, "k", [2, 3], (2, 3)) is None
+    assert compare(entry, "k", [2, 3], [3, 2]) == {
+        "id": "e1", "hash": "k", "browser_lines": 2, "expected_lines": 2,
+        "first_difference": {"line": 1, "browser": "one two", "expected": "one two three"}}
+    assert compare(entry, "k", [2, 2, 1], [2, 2])["first_difference"] == {"line": 3, "browser": "five", "expected": None}
+
+
+def test_expected_counts_cover_every_word(font_path):
+    entry = {"id": "e1", "text": TEXT, "width": "300px", "family": "DejaVuSans", "size": "12pt"}
+    for against in ("bkm", "textlayout"):
+        counts = expected_counts(entry, against, "freetype")
+        assert len(counts) > 1 and sum(counts) == len(TEXT.split())
+        assert expected_counts({**entry, "width": "600px"}, against, "freetype") != counts
+
+
+def test_verify_computes_expected_breaks_outside_the_browser_loop(monkeypatch):
+    entries = [{"id": "e1", "text": "one two three", "width": "300px", "family": "Font", "size": "12pt"},
+               {"id": "e2", "text": "four five", "width": "300px", "family": "Missing", "size": "12pt"}]
+
+    async def extract_all(html_file, tabs, headless, cache):
+        return entries, ["k1", "k2"], {"k1": [2, 1], "k2": [2]}, 1
+
+    def counts(entry, against, measurer):
+        # The Playwright measurer starts an event loop of its own, so none may be running here.
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("expected breaks computed inside a running event loop")
+        if entry["family"] == "Missing":
+            raise FileNotFoundError("No font file found for 'Missing'")
+        return [3]
+
+    monkeypatch.setattr(paragraph, "extract_all", extract_all)
+    monkeypatch.setattr(paragraph, "expected_counts", counts)
+    summary = paragraph.verify("index.html", report="report.json")
+    assert (summary["paragraphs"], summary["cached"], summary["mismatches"], summary["errors"]) == (2, 1, 1, 1)
+    with open("report.json", encoding="utf-8") as f:
+        report = json.load(f)
+    assert report["mismatches"][0]["first_difference"] == {"line": 1, "browser": "one two", "expected": "one two three"}
+    assert report["errors"] == [{"id": "e2", "hash": "k2", "error": "No font file found for 'Missing'"}]
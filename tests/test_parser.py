@@ -0,0 +1,95 @@
+import os
+import re
+
+import parser
+from parser import compile_program, execute, program
+
+# The regex-based parser that tokenize() replaced, kept as the reference its output has to match.
+BLOCK_PATTERN = re.compile(r";(\w+)\((.*?)\)(?:\s*:\s*(.*?))?(?=(?:\n\s*;|$))", re.DOTALL)
+VAR_ASSIGN_PATTERN = re.compile(r";(\w+)\s*=\s*(.*?)(?=(?:\n\s*;|$))", re.DOTALL)
+
+
+def reference(code):
+    variables = {}
+    for name, value in VAR_ASSIGN_PATTERN.findall(code):
+        variables[name] = parser.parse_value(value, variables)
+    result = []
+    for func, args, content in BLOCK_PATTERN.findall(code):
+        func = variables.get(func, func)
+        result.append({"func": func, "args": parser.parse_args(args, variables) if args else {},
+                       "content": content.strip() if content else ""})
+    return result
+
+
+SOURCES = [
+    ";document()\n;setmargin(all=12)\n\n;setfont(name=\"font\", size=6)\n\n;paragraph()\n",
+    ";document(unit=mm, size=A5, margin=(10, 20, 10, 20), spread=false)\n;page()\n"
+    ";paragraph(font=(DejaVuSans, 12), width=0.5):\nFirst paragraph\nspanning two lines.\n\n"
+    ";paragraph(): Inline content after the colon\n;lorem(paragraphs=2)\n",
+    ";size = 14\n;p = paragraph\n;document()\n;p(font=(Helvetica, ;size)):\nAliased call with a variable.\n",
+    ";heading(text=Nested (parentheses) here, level=1)\n;paragraph():\nText with (brackets) and a ; semicolon inside.\n",
+    "Text before the first command is ignored\n;document()\n  ;page()\n;paragraph():\n\n\nbody after blank lines\n\n",
+]
+
+
+def test_tokenizer_matches_reference_parser():
+    for code in SOURCES:
+        assert compile_program(code) == reference(code), code
+
+
+def test_tokenizer_only_splits_lines_on_newlines():
+    code = ";paragraph():\none\u2028two\x0cthree\u2029;four\x85five\n;page()\n"
+    assert compile_program(code) == reference(code)
+    assert compile_program(code)[0]["content"] == "one\u2028two\x0cthree\u2029;four\x85five"
+    assert compile_program(code.replace("\n", "\r\n"))[0]["content"] == "one\u2028two\x0cthree\u2029;four\x85five"
+
+
+def test_tokenizer_matches_reference_parser_on_repo_sources():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name in ("document.bkm", "messages.bkm"):
+        with open(os.path.join(root, name)) as f:
+            code = f.read().rstrip("\n") + "\n"
+        assert compile_program(code) == reference(code), name
+
+
+def test_tokenizer_keeps_a_last_block_followed_by_blank_lines():
+    # The old pattern's lookahead only matched "$" before a single trailing newline, so it dropped this block.
+    code = ";document()\n;paragraph()\n\n"
+    assert reference(code) == [{"func": "document", "args": {}, "content": ""}]
+    assert compile_program(code) == reference(code) + [{"func": "paragraph", "args": {}, "content": ""}]
+
+
+def test_program_cache_round_trip():
+    code = SOURCES[1]
+    assert program(code, "doc.bkm") == compile_program(code)
+    assert program(code, "doc.bkm") == compile_program(code)
+    assert isinstance(program(code, "doc.bkm")[0]["args"]["margin"], tuple)
+
+
+def test_program_cache_keeps_one_entry_per_source():
+    program(SOURCES[0], "doc.bkm")
+    program(SOURCES[1], "doc.bkm")
+    program(SOURCES[1], "other.bkm")
+    assert len(os.listdir(parser.CACHE_DIR)) == 2
+
+
+def test_program_cache_prunes_sources_without_a_path(monkeypatch):
+    monkeypatch.setattr(parser, "MAX_PROGRAMS", 3)
+    for i in range(5):
+        program(f";page(n={i})\n")
+    assert len(os.listdir(parser.CACHE_DIR)) == 3
+
+
+def test_program_cache_ignores_invalid_files():
+    code = SOURCES[0]
+    program(code, "doc.bkm")
+    [name] = os.listdir(parser.CACHE_DIR)
+    for junk in (f'{{"version": {parser.VERSION}, "key": "0", "blocks": []}}', "not json", f'{{"version": {parser.VERSION}}}'):
+        with open(os.path.join(parser.CACHE_DIR, name), "w") as f:
+            f.write(junk)
+        assert program(code, "doc.bkm") == compile_program(code)
+
+
+def test_execute_warns_about_unknown_functions(capsys):
+    execute(object(), {"func": "missing", "args": {}, "content": ""})
+    assert "warning: ignoring unknown function: missing" in capsys.readouterr().err
@@ -0,0 +1,93 @@
+import shutil
+import sqlite3
+
+from text_metrics import cache_manager
+from text_metrics.cache_manager import FontShard, WordCacheManager, fingerprint
+
+
+def font_files(tmp_path):
+    first, second = tmp_path / "first.ttf", tmp_path / "second.ttf"
+    first.write_bytes(b"first font")
+    second.write_bytes(b"second font")
+    return str(first), str(second)
+
+
+def test_font_shard_round_trip(tmp_path):
+    path, _ = font_files(tmp_path)
+    WordCacheManager.get_font_cache("Font_12pt", path)
+    WordCacheManager.update_font_cache("Font_12pt", {"hello": 30.5, " ": 4.0}, used=["hello", " "])
+    WordCacheManager.save_cache()
+
+    WordCacheManager._shards = {}
+    assert WordCacheManager.get_font_cache("Font_12pt", path) == {"hello": 30.5, " ": 4.0}
+
+
+def test_font_shard_only_loads_words_of_its_font_file(tmp_path):
+    first, second = font_files(tmp_path)
+    WordCacheManager.get_font_cache("Font_12pt", first)
+    WordCacheManager.update_font_cache("Font_12pt", {"hello": 30.5})
+    WordCacheManager.save_cache()
+
+    # The same family and size in another font file measures differently.
+    WordCacheManager._shards = {}
+    assert WordCacheManager.get_font_cache("Font_12pt", second) == {}
+    WordCacheManager.update_font_cache("Font_12pt", {"hello": 31.0})
+    WordCacheManager.save_cache()
+
+    # Builds using the old file keep their words until they are the least recently used.
+    WordCacheManager._shards = {}
+    assert WordCacheManager.get_font_cache("Font_12pt", first) == {"hello": 30.5}
+    db = sqlite3.connect(FontShard("Font_12pt").path)
+    assert db.execute("SELECT COUNT(*) FROM words").fetchone() == (2,)
+    db.close()
+
+
+def test_font_shard_drops_least_recently_used_words(tmp_path, monkeypatch):
+    path, _ = font_files(tmp_path)
+    monkeypatch.setattr(cache_manager, "MAX_WORDS", 2)
+    times = iter(range(100))
+    monkeypatch.setattr(cache_manager.time, "time", lambda: next(times))
+    WordCacheManager.get_font_cache("Font_12pt", path)
+    for word in ("a", "b"):
+        WordCacheManager.update_font_cache("Font_12pt", {word: 1.0})
+        WordCacheManager.save_cache()
+    WordCacheManager.update_font_cache("Font_12pt", {}, used=["a"])
+    WordCacheManager.save_cache()
+    WordCacheManager.update_font_cache("Font_12pt", {"c": 1.0})
+    WordCacheManager.save_cache()
+
+    WordCacheManager._shards = {}
+    assert WordCacheManager.get_font_cache("Font_12pt", path) == {"a": 1.0, "c": 1.0}
+
+
+def test_fingerprint_follows_file_contents(tmp_path):
+    first, second = font_files(tmp_path)
+    assert fingerprint(first) != fingerprint(second)
+    assert fingerprint(str(tmp_path / "missing.ttf")) == ""
+    shutil.copyfile(first, second)
+    assert fingerprint(first) == fingerprint(second)
+
+
+def test_font_metric_round_trip():
+    assert WordCacheManager.font_metric("abc", "line_height_ratio") is None
+    WordCacheManager.update_font_metric("abc", "line_height_ratio", 1.25)
+    WordCacheManager.save_cache()
+
+    WordCacheManager._metrics = None
+    assert WordCacheManager.font_metric("abc", "line_height_ratio") == 1.25
+    assert WordCacheManager.font_metric("def", "line_height_ratio") is None
+
+
+def test_freetype_metrics_cache_word_widths(font_path):
+    from text_metrics.metrics import TextMetrics
+    metrics = TextMetrics(("DejaVuSans", "12pt"), backend="freetype")
+    widths, space = metrics.measure_words(["hello", "world", "hello"])
+    assert set(widths) == {"hello", "world"}
+    assert space > 0 and widths["hello"] > widths["world"] / 2
+    assert metrics.line_height() > 12
+    TextMetrics.save()
+
+    WordCacheManager._shards = {}
+    again = TextMetrics(("DejaVuSans", "12pt"), backend="freetype")
+    assert again.word_cache["hello"] == widths["hello"]
+    assert again.measure_words(["hello"]) == ({"hello": widths["hello"]}, space)
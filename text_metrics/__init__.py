@@ -1,3 +1,10 @@
-from .metrics import TextMetrics
-
+# TextMetrics is imported on first use, so importing a helper such as text_metrics.cache_manager
+# doesn't load the measurers and FreeType with it.
 __all__ = ["TextMetrics"]
+
+
+def __getattr__(name):
+    if name == "TextMetrics":
+        from .metrics import TextMetrics
+        return TextMetrics
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
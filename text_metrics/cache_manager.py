@@ -1,35 +1,157 @@
-import json
+import atexit
+import hashlib
 import os
+import re
+import sqlite3
+import time
+
+from instrument import span
+
+CACHE_DIR = os.path.join(".bookmark", "words")
+MAX_WORDS = 200_000
+# Metrics calibrated per font file, shared by every size of it
+METRICS_PATH = os.path.join(CACHE_DIR, "metrics.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS words (
+    fingerprint TEXT NOT NULL,
+    word TEXT NOT NULL,
+    width REAL NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (fingerprint, word)
+);
+"""
+
+METRICS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    fingerprint TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (fingerprint, name)
+);
+"""
+
+_fingerprints = {}
+
+def fingerprint(path):
+    """Hash of the font file's contents, memoized per path, size and mtime."""
+    if not path or not os.path.isfile(path):
+        return ""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _fingerprints:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        _fingerprints[key] = digest.hexdigest()
+    return _fingerprints[key]
+
+
+class FontShard:
+    """Word widths of one font and size, loaded from and flushed to its own SQLite file."""
+    def __init__(self, font_key, font_path=None):
+        self.path = os.path.join(CACHE_DIR, re.sub(r"[^\w.-]", "_", font_key) + ".sqlite")
+        self.fingerprint = fingerprint(font_path)
+        self.words = {}
+        self.new = {}
+        self.used = set()
+        if os.path.exists(self.path):
+            db = self.connect()
+            try:
+                self.words = dict(db.execute("SELECT word, width FROM words WHERE fingerprint = ?", (self.fingerprint,)))
+            finally:
+                db.close()
+
+    def connect(self):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        return db
+
+    def flush(self):
+        if not self.new and not self.used:
+            return
+        now = time.time()
+        db = self.connect()
+        try:
+            with db:
+                db.executemany("INSERT OR REPLACE INTO words VALUES (?, ?, ?, ?)",
+                               [(self.fingerprint, word, width, now) for word, width in self.new.items()])
+                db.executemany("UPDATE words SET used = ? WHERE fingerprint = ? AND word = ?",
+                               [(now, self.fingerprint, word) for word in self.used - self.new.keys()])
+                # Other builds may be using another version of the font, so entries for old fingerprints
+                # aren't deleted outright; like every entry, they go once they're the least recently used.
+                db.execute("DELETE FROM words WHERE rowid IN (SELECT rowid FROM words ORDER BY used DESC LIMIT -1 OFFSET ?)", (MAX_WORDS,))
+        finally:
+            db.close()
+        self.new = {}
+        self.used = set()
 
-CACHE_FILE = "word_cache.json"
 
 class WordCacheManager:
-    _global_cache = None
+    _shards: dict[str, FontShard] = {}
+    # (fingerprint, name) -> value, loaded on first use
+    _metrics: dict[tuple[str, str], float] | None = None
+    _new_metrics: dict[tuple[str, str], float] = {}
+    hits = 0
+    misses = 0
 
     @classmethod
-    def load_cache(cls):
-        if cls._global_cache is None:
-            if os.path.exists(CACHE_FILE):
-                with open(CACHE_FILE, "r") as f:
-                    cls._global_cache = json.load(f)
-            else:
-                cls._global_cache = {}
-        return cls._global_cache
+    def shard(cls, font_key, font_path=None):
+        if font_key not in cls._shards:
+            cls._shards[font_key] = FontShard(font_key, font_path)
+        return cls._shards[font_key]
 
     @classmethod
     def save_cache(cls):
-        if cls._global_cache is not None:
-            with open(CACHE_FILE, "w") as f:
-                json.dump(cls._global_cache, f, indent=2)
+        with span("save"):
+            for shard in cls._shards.values():
+                shard.flush()
+            if cls._new_metrics:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                db = sqlite3.connect(METRICS_PATH, timeout=30)
+                try:
+                    with db:
+                        db.executescript(METRICS_SCHEMA)
+                        db.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?)",
+                                       [(fingerprint, name, value) for (fingerprint, name), value in cls._new_metrics.items()])
+                finally:
+                    db.close()
+                cls._new_metrics = {}
+
+    @classmethod
+    def get_font_cache(cls, font_key, font_path=None):
+        return cls.shard(font_key, font_path).words
 
     @classmethod
-    def get_font_cache(cls, font_key):
-        cls.load_cache()
-        return cls._global_cache.get(font_key, {})
+    def update_font_cache(cls, font_key, word_dict, used=()):
+        """Record new widths and the words a paragraph used; nothing is written until save_cache()."""
+        shard = cls.shard(font_key)
+        shard.words.update(word_dict)
+        shard.new.update(word_dict)
+        shard.used.update(used)
 
     @classmethod
-    def update_font_cache(cls, font_key, word_dict):
-        cls.load_cache()
-        cls._global_cache[font_key] = word_dict
-        # Optionally defer saving to end of program
-        cls.save_cache()
+    def font_metric(cls, fingerprint, name):
+        """A metric calibrated for the font file with `fingerprint`, or None if it hasn't been yet."""
+        if cls._metrics is None:
+            cls._metrics = {}
+            if os.path.exists(METRICS_PATH):
+                db = sqlite3.connect(METRICS_PATH, timeout=30)
+                try:
+                    db.executescript(METRICS_SCHEMA)
+                    cls._metrics = {(f, n): v for f, n, v in db.execute("SELECT fingerprint, name, value FROM metrics")}
+                finally:
+                    db.close()
+        return cls._metrics.get((fingerprint, name))
+
+    @classmethod
+    def update_font_metric(cls, fingerprint, name, value):
+        cls.font_metric(fingerprint, name)
+        cls._metrics[fingerprint, name] = value
+        cls._new_metrics[fingerprint, name] = value
+
+
+atexit.register(WordCacheManager.save_cache)
@@ -0,0 +1,109 @@
+import os
+import freetype
+
+DPI = 96
+
+FONT_DIRS = [
+    "~/Library/Fonts",
+    "/Library/Fonts",
+    "/System/Library/Fonts",
+    "/System/Library/Fonts/Supplemental",
+    "~/.fonts",
+    "~/.local/share/fonts",
+    "/usr/share/fonts",
+    "/usr/local/share/fonts",
+    "C:/Windows/Fonts",
+]
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc")
+
+_font_files = None
+_font_families = None
+_line_metrics = {}
+_resolved = {}
+
+
+def points(size):
+    return float(str(size).strip().removesuffix("pt"))
+
+def normalize(name):
+    return "".join(c for c in name.lower() if c.isalnum())
+
+def font_files():
+    global _font_files
+    if _font_files is None:
+        _font_files = {}
+        for directory in FONT_DIRS:
+            for root, _, files in os.walk(os.path.expanduser(directory)):
+                for file in files:
+                    if file.lower().endswith(FONT_EXTENSIONS):
+                        _font_files.setdefault(normalize(os.path.splitext(file)[0]), os.path.join(root, file))
+    return _font_files
+
+def font_families():
+    # Opening every face is slow, so the family-name index is only built when a file-name lookup misses.
+    global _font_families
+    if _font_families is None:
+        _font_families = {}
+        for path in font_files().values():
+            try:
+                face = freetype.Face(path)
+            except freetype.FT_Exception:
+                continue
+            family = normalize(face.family_name.decode("utf-8", "ignore"))
+            if face.style_name in (b"Regular", b"Roman", b"Book") or family not in _font_families:
+                _font_families[family] = path
+    return _font_families
+
+def resolve_font(family, scan=True):
+    """Path of the font file for `family`: a path, a file name, or (with `scan`) a family name found by opening every font."""
+    if (family, scan) not in _resolved:
+        path = os.path.expanduser(family)
+        if not os.path.isfile(path):
+            key = normalize(family)
+            path = font_files().get(key) or (font_families().get(key) if scan else None)
+        _resolved[family, scan] = path
+    return _resolved[family, scan]
+
+def line_metrics(path):
+    """Ascender, descender and line gap of the font at `path` as fractions of the em, from its hhea table."""
+    if path not in _line_metrics:
+        face = freetype.Face(path)
+        em = face.units_per_EM
+        _line_metrics[path] = (face.ascender / em, -face.descender / em, (face.height - face.ascender + face.descender) / em)
+    return _line_metrics[path]
+
+
+class FreeTypeTextMeasurer:
+    def __init__(self, font=("Arial", "16"), path=None):
+        self.font_family, self.font_size = font
+        self.path = path if path else resolve_font(self.font_family)
+        if self.path is None:
+            raise FileNotFoundError(f"No font file found for {self.font_family!r}")
+        self.face = freetype.Face(self.path)
+        # CSS pt sizes are rendered at 96 DPI, so widths come out in px like ctx.measureText.
+        self.size_px = points(self.font_size) * DPI / 72
+        self.scale = self.size_px / self.face.units_per_EM
+        self.advances = {}
+
+    def measure_line_height(self):
+        ascender, descender, line_gap = line_metrics(self.path)
+        return (ascender + descender + line_gap) * self.size_px
+
+    def advance(self, char):
+        if char not in self.advances:
+            self.face.load_char(char, freetype.FT_LOAD_NO_SCALE)
+            self.advances[char] = self.face.glyph.advance.x
+        return self.advances[char]
+
+    def width(self, word):
+        units = 0
+        prev = None
+        for char in word:
+            units += self.advance(char)
+            if prev and self.face.has_kerning:
+                units += self.face.get_kerning(prev, char, freetype.FT_KERNING_UNSCALED).x
+            prev = char
+        return units * self.scale
+
+    def measure_words(self, words):
+        return {word: self.width(word) for word in words}
@@ -1,58 +1,91 @@
-from playwright.sync_api import sync_playwright
+import asyncio
+import atexit
+import math
+from playwright.async_api import async_playwright
+
+PAGES = 4
+CHUNK_SIZE = 2000
+
+JS_WORD_WIDTHS = """
+([font, words]) => {
+    const ctx = document.createElement('canvas').getContext('2d');
+    ctx.font = font;
+    return words.map(word => ctx.measureText(word).width);
+}
+"""
+
+JS_LINE_HEIGHT = """
+([family, size]) => {
+    const p = document.createElement('p');
+    p.style.fontFamily = family;
+    p.style.fontSize = size + 'pt';
+    p.style.lineHeight = 'normal';
+    p.innerText = 'Hg';
+    document.body.appendChild(p);
+    const rect = p.getBoundingClientRect();
+    document.body.removeChild(p);
+    return rect.height;
+}
+"""
+
+
+class BrowserPool:
+    """A headless Chromium kept alive for the whole process, with a few pages to measure on in parallel."""
+    _instance = None
+
+    def __init__(self, pages=PAGES):
+        self.loop = asyncio.new_event_loop()
+        self.playwright = self.run(async_playwright().start())
+        self.browser = self.run(self.playwright.chromium.launch(headless=True))
+        self.pages = [self.run(self.browser.new_page()) for _ in range(pages)]
+        atexit.register(self.close)
+
+    @classmethod
+    def get(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def evaluate(self, script, args):
+        """Evaluate `script` once per entry of `args`, spread over the pool's pages."""
+        return self.run(asyncio.gather(*(self.pages[i % len(self.pages)].evaluate(script, arg) for i, arg in enumerate(args))))
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.run(self.browser.close())
+        self.run(self.playwright.stop())
+        self.loop.close()
+        BrowserPool._instance = None
+
 
 class PlaywrightTextMeasurer:
     def __init__(self, font=("Arial", "16")):
         self.font_family, self.font_size = font
         self.font_css = f"{self.font_size} {self.font_family}"
 
+    @property
+    def pool(self):
+        return BrowserPool.get()
+
     def measure_line_height(self):
-        height = 0
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            page = browser.new_page()
-
-            height = page.evaluate(f"""
-                () => {{
-                    const p = document.createElement('p');
-                    p.style.fontFamily = '{self.font_family}';
-                    p.style.fontSize = '{self.font_size}pt';
-                    p.style.lineHeight = '1.2';
-                    p.innerText = 'Hg';
-                    document.body.appendChild(p);
-                    const rect = p.getBoundingClientRect();
-                    document.body.removeChild(p);
-                    return rect.height;
-                }}
-            """)
-
-            browser.close()
-        return height
+        return self.pool.evaluate(JS_LINE_HEIGHT, [[self.font_family, self.font_size]])[0]
 
     def measure_text(self, html, id):
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            page = browser.new_page()
-            page.set_content(html)
+        self.pool.run(self.pool.pages[0].set_content(html))
 
     def measure_words(self, words):
-        result = {}
-
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            page = browser.new_page()
-            for word in words:
-                print(word)
-                width = page.evaluate(f"""
-                    () => {{
-                        const p = document.createElement('p');
-                        p.style.font = '{self.font_size}pt {self.font_family}';
-                        p.innerText = {word!r};
-                        const canvas = document.createElement('canvas');
-                        const ctx = canvas.getContext('2d');
-                        ctx.font = p.style.font;
-                        return ctx.measureText(p.innerText).width;
-                    }}
-                """)
-                result[word] = width
-            browser.close()
-        return result
+        words = list(dict.fromkeys(words))
+        if not words:
+            return {}
+
+        chunks = min(len(self.pool.pages), math.ceil(len(words) / CHUNK_SIZE))
+        size = math.ceil(len(words) / chunks)
+        batches = [words[i:i+size] for i in range(0, len(words), size)]
+
+        font = f"{self.font_size}pt {self.font_family}"
+        widths = self.pool.evaluate(JS_WORD_WIDTHS, [[font, batch] for batch in batches])
+        return {word: width for batch, batch_widths in zip(batches, widths) for word, width in zip(batch, batch_widths)}
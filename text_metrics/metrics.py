@@ -1,24 +1,85 @@
 # metrics.py
-from .measurer import PlaywrightTextMeasurer
-from .cache_manager import WordCacheManager
+from .freetype_measurer import FreeTypeTextMeasurer, resolve_font, line_metrics, points, DPI
+from .cache_manager import WordCacheManager, fingerprint
+from instrument import span, count
+
+# Line heights per (font key, font file), computed once per process
+LINE_HEIGHTS = {}
 
 class TextMetrics:
-    def __init__(self, font=("Arial","16pt")):
+    def __init__(self, font=("Arial","16pt"), backend="playwright"):
         self.font_family, self.font_size = font
+        self.measurer = self.create_measurer(font, backend)
         self.font_key = f"{self.font_family}_{self.font_size}"
-        self.measurer = PlaywrightTextMeasurer(font)
-        self.word_cache = WordCacheManager.get_font_cache(self.font_key)
+        if isinstance(self.measurer, FreeTypeTextMeasurer):
+            self.font_key += "_freetype"
+        self._font_path = None
+
+    @property
+    def font_path(self):
+        """The font file, found when a fingerprint or font metrics are first needed. The browser resolves families
+        itself, so for Playwright this only looks the family up by file name instead of opening every system font."""
+        if self._font_path is None:
+            if isinstance(self.measurer, FreeTypeTextMeasurer):
+                self._font_path = self.measurer.path
+            else:
+                self._font_path = resolve_font(self.font_family, scan=False) or ""
+        return self._font_path or None
+
+    @property
+    def word_cache(self):
+        return WordCacheManager.get_font_cache(self.font_key, self.font_path)
+
+    @staticmethod
+    def create_measurer(font, backend):
+        if backend == "freetype":
+            path = resolve_font(font[0])
+            if path is not None:
+                return FreeTypeTextMeasurer(font, path)
+        elif backend != "playwright":
+            raise ValueError(f"Unknown measurer backend: {backend}")
+        # Imported here so only Playwright measurements pay for loading it.
+        from .measurer import PlaywrightTextMeasurer
+        return PlaywrightTextMeasurer(font)
+
+    @staticmethod
+    def save():
+        WordCacheManager.save_cache()
 
     def line_height(self):
-        return self.measurer.measure_line_height()
+        key = (self.font_key, self.font_path)
+        if key not in LINE_HEIGHTS:
+            LINE_HEIGHTS[key] = self.measure_line_height()
+        return LINE_HEIGHTS[key]
+
+    def measure_line_height(self):
+        """The font's normal line height: ascender + descender + line gap of the font file, scaled for Playwright
+        by the ratio of the browser's `line-height: normal` to it.
+
+        The ratio doesn't depend on the size, so the browser is only asked once per font file (by fingerprint).
+        """
+        if self.font_path is None or isinstance(self.measurer, FreeTypeTextMeasurer):
+            return self.measurer.measure_line_height()
+        ascender, descender, line_gap = line_metrics(self.font_path)
+        height = (ascender + descender + line_gap) * points(self.font_size) * DPI / 72
+        key = fingerprint(self.font_path)
+        ratio = WordCacheManager.font_metric(key, "line_height_ratio")
+        if ratio is None:
+            ratio = self.measurer.measure_line_height() / height
+            WordCacheManager.update_font_metric(key, "line_height_ratio", ratio)
+        return height * ratio
 
     def measure_words(self, words:list[str]):
         words.append(" ")
-        result = {cached: width for cached, width in self.word_cache.items()}
-        for word, width in self.measurer.measure_words([w for w in words if w not in self.word_cache]).items():
-            result[word] = width
-            self.word_cache[word] = width
+        missing = [w for w in words if w not in self.word_cache]
+        WordCacheManager.hits += len(words) - len(missing)
+        WordCacheManager.misses += len(missing)
+        count("word_cache.hit", len(words) - len(missing))
+        count("word_cache.miss", len(missing))
+        with span("measure"):
+            measured = self.measurer.measure_words(missing)
+        WordCacheManager.update_font_cache(self.font_key, measured, used=words)
+        result = {word: self.word_cache[word] for word in words}
         space_width = result.pop(words.pop())
 
-        WordCacheManager.update_font_cache(self.font_key, self.word_cache)
         return (result, space_width)